@@ -6,23 +6,35 @@
 #license:Creative Commons GNU GPL v2
 # (http://creativecommons.org/licenses/GPL/2.0/)
 
+import contextlib
 import os
-import datetime
-import json
 import re
+import time
+import threading
+import traceback
 
+import gobject
 import gtk
+import instrument
 import kindle
+import search
 
 VERSION = '0.2'
+# Rows changed at once above which a view is detached from its model
+DETACH_ROWS = 100
 
 class KindleUI:
     '''Interface for manipulating a Kindle collection JSON file
     '''
     def __init__(self):
         self.root = os.getcwd()
-        self.filemodel = gtk.TreeStore(str, str, bool)
+        # Folder rows keep their filetree path in the last column
+        self.filemodel = gtk.TreeStore(str, str, bool, str)
         self.fileview = self.get_view('Files', self.filemodel, 'fileview')
+        self.fileview.connect("test-expand-row", self.expand_folder)
+        self.index = search.SearchIndex()
+        # Expanded folder rows to restore when the search box is cleared
+        self.expanded = list()
         self.colmodel = gtk.TreeStore(str, str, str)
         self.colview = self.get_view('Collections', self.colmodel, 'colview')
 
@@ -41,16 +53,22 @@ class KindleUI:
         self.filechooser = gtk.FileChooserButton(filechooserdiag)
         self.filechooser.connect("current-folder-changed", self.load)
 
-        file_toolbar = gtk.HBox()
+        self.file_toolbar = file_toolbar = gtk.HBox()
         file_toolbar.pack_start(self.filechooser, True, True, 2)
         file_toolbar.pack_start(self.get_button('gtk-refresh', 'Refresh files', self.refresh), False, True, 2)
         file_toolbar.pack_start(self.get_button('gtk-open', 'Open collection file', self.open_collection, "O"), False, True, 2)
         file_toolbar.pack_start(gtk.VSeparator(), False, True, 2)
         file_toolbar.pack_start(self.get_button('gtk-save', 'Save collection file', self.save, "S"), False, True, 2)
 
-        hbox_main = gtk.HBox()
+        self.hbox_main = hbox_main = gtk.HBox()
         filescroll = gtk.ScrolledWindow()
         filescroll.add(self.fileview)
+        self.search_entry = gtk.Entry()
+        self.search_entry.set_tooltip_text("Search titles, filenames and ASINs")
+        self.search_entry.connect("changed", self.search)
+        file_pane = gtk.VBox()
+        file_pane.pack_start(self.search_entry, False, True, 2)
+        file_pane.add(filescroll)
         colscroll = gtk.ScrolledWindow()
         colscroll.add(self.colview)
         col_toolbar = gtk.VBox()
@@ -61,9 +79,13 @@ class KindleUI:
         col_toolbar.pack_start(self.get_button('gtk-go-forward', 'Add book to collection', self.add_file), False, True, 2)
         col_toolbar.pack_start(self.get_button('gtk-go-back', 'Remove book from collection', self.del_file), False, True, 2)
         col_toolbar.pack_start(gtk.HSeparator(), False, True, 7)
+        col_toolbar.pack_start(self.get_button('gtk-clear', 'Remove books missing from the Kindle', self.purge_orphans), False, True, 2)
+        col_toolbar.pack_start(self.get_button('gtk-copy', 'Find duplicate books', self.find_duplicates), False, True, 2)
+        col_toolbar.pack_start(self.get_button('gtk-undo', 'Undo', self.undo, "Z"), False, True, 2)
+        col_toolbar.pack_start(self.get_button('gtk-redo', 'Redo', self.redo, "Y"), False, True, 2)
         col_toolbar.pack_start(self.get_button('gtk-revert-to-saved', 'Revert collections', self.revert), False, True, 2)
 
-        hbox_main.add(filescroll)
+        hbox_main.add(file_pane)
         hbox_main.pack_start(col_toolbar, False, False, 2)
         hbox_main.add(colscroll)
 
@@ -76,7 +98,6 @@ class KindleUI:
         self.window.add(vbox_main)
         self.window.show_all()
         self.status("Select your Kindle's home folder")
-        gtk.main()
 
     def get_button(self, image, tooltip, cb, accelkey=None):
         button = gtk.Button()
@@ -99,46 +120,112 @@ class KindleUI:
         if not self.root == current:
             self.status("Loading... please wait")
             self.root = current
-            self.kindle = kindle.Kindle(self.root)
-            self.filemodel.clear()
-            self.colmodel.clear()
-            if self.kindle.is_connected():
-                self.colfile = os.path.join(self.root, 'system', 'collections.json')
-                self.db = kindle.CollectionDB(self.colfile)
-                self.refresh(widget)
-                self.revert(widget)
-                self.status("Kindle Loaded")
+            # Idle callbacks run after pending redraws, so the window is
+            # painted before the device is touched
+            gobject.idle_add(self.open_kindle)
+
+    def open_kindle(self):
+        self.kindle = kindle.Kindle(self.root)
+        self.filemodel.clear()
+        self.colmodel.clear()
+        if self.kindle.is_connected():
+            self.colfile = os.path.join(self.root, 'system', 'collections.json')
+            self.db = kindle.CollectionDB(self.colfile)
+            self.fill_files()
+            self.scan(self.kindle.init_data, self.load_done)
+        else:
+            self.status("Kindle files not found")
+        return False
+
+    def load_done(self, changes):
+        self.revert(None)
+        orphans = sum(len(items) for items in self.db.get_orphans(self.kindle).itervalues())
+        if orphans:
+            self.status("Kindle Loaded: %d files, %d collection items of missing books" % (len(self.kindle.files), orphans))
+        else:
+            self.status("Kindle Loaded: %d files" % len(self.kindle.files))
+
+    # Runs a Kindle scan, or another read of the device, in a worker thread.
+    # The main loop adds rows as scan batches arrive
+    def scan(self, method, done):
+        self.set_busy(True)
+        started = time.time()
+        def progress(changes, count, total):
+            gobject.idle_add(self.scan_progress, changes, count, total, time.time() - started)
+        def run():
+            try:
+                changes = method(progress)
+            except Exception, e:
+                traceback.print_exc()
+                gobject.idle_add(self.scan_failed, e)
             else:
-                self.status("Kindle files not found")
+                gobject.idle_add(self.scan_done, done, changes)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def scan_progress(self, changes, count, total, elapsed):
+        with self.kindle.lock, instrument.phase('model'):
+            self.update_files(changes)
+            if self.fileview.get_model() is not self.filemodel:
+                self.search(self.search_entry)
+        rate = 0
+        if elapsed > 0:
+            rate = count / elapsed
+        self.status("Scanning... %d/%d files, %d files/s" % (count, total, rate))
+        return False
+
+    def scan_done(self, done, changes):
+        self.set_busy(False)
+        done(changes)
+        return False
+
+    def scan_failed(self, error):
+        self.set_busy(False)
+        self.status("Scan failed: %s" % error)
+        return False
+
+    # Blocks edits while a scan thread is updating the Kindle
+    def set_busy(self, busy):
+        self.file_toolbar.set_sensitive(not busy)
+        self.hbox_main.set_sensitive(not busy)
 
     def get_collections(self):
         for collection in self.db:
-            citer = self.colmodel.append(None, [collection, "", ""])
-            for namehash in self.db[collection]['items']:
-                if re.match('\*[\w]', namehash):
-                    namehash = str(namehash.lstrip("*"))
-                asin = re.match('\#([\w\-]+)\^\w{4}', namehash)
-                if asin:
-                    asin = asin.group(1)
-                    try:
-                        book = self.kindle.searchAsin(asin)
-                        namehash = book.hash
-                    except:
-                        namehash = None
-                        print "! ASIN %s belongs to collection %s but wasn't found on the device!" %( asin, collection )
-                if namehash in self.kindle.files:
-                    if self.kindle.files[namehash].title:
-                        filename = self.kindle.files[namehash].title
-                    else:
-                        filename = os.path.basename(self.kindle.files[namehash].path)
-                    if self.kindle.files[namehash].asin:
-                        asin = self.kindle.files[namehash].asin
-                    else:
-                        asin = ""
-                    fiter = self.colmodel.append(citer, [filename, namehash, asin])
-                    #if asin != "":
-                    #else:
-                    #for row in self.filemodel
+            self.add_collection_rows(collection)
+
+    # Adds the row of a collection and the rows of its items
+    def add_collection_rows(self, collection):
+        citer = self.colmodel.append(None, [collection, "", ""])
+        for namehash in self.db[collection]['items']:
+            self.add_item_row(citer, collection, namehash)
+        return citer
+
+    def add_item_row(self, citer, collection, namehash):
+        if re.match('\*[\w]', namehash):
+            namehash = str(namehash.lstrip("*"))
+        asin = re.match('\#([\w\-]+)\^\w{4}', namehash)
+        if asin:
+            asin = asin.group(1)
+            book = self.kindle.searchAsin(asin)
+            if book:
+                namehash = book.hash
+            else:
+                namehash = None
+                print "! ASIN %s belongs to collection %s but wasn't found on the device!" %( asin, collection )
+        if namehash in self.kindle.files:
+            if self.kindle.files[namehash].title:
+                filename = self.kindle.files[namehash].title
+            else:
+                filename = os.path.basename(self.kindle.files[namehash].path)
+            if self.kindle.files[namehash].asin:
+                asin = self.kindle.files[namehash].asin
+            else:
+                asin = ""
+            fiter = self.colmodel.append(citer, [filename, namehash, asin])
+            #if asin != "":
+            #else:
+            #for row in self.filemodel
 
     def add_collection(self, widget):
         (dialog, input_box) = self.collection_prompt("Add Collection", "New Collection name:")
@@ -156,7 +243,7 @@ class KindleUI:
             treesel.select_iter(coliter)
             treepath = treesel.get_selected_rows()[1][0]
             self.colview.scroll_to_cell(treepath)
-            self.db[colname] = kindle.Collection({ 'locale': 'en-US', 'items': [], 'lastAccess': 0})
+            self.db.add_collection(colname)
         else:
             self.status("%s collection already exists" % colname)
 
@@ -201,6 +288,75 @@ class KindleUI:
         dialog.show_all()
         return dialog
 
+    # Removes the items of books missing from the Kindle from every collection
+    def purge_orphans(self, widget):
+        orphans = self.db.get_orphans(self.kindle)
+        if not orphans:
+            self.status("No collection items of missing books")
+            return
+        dialog = self.purge_orphans_prompt(orphans)
+        if dialog.run() == gtk.RESPONSE_ACCEPT:
+            removed = self.db.purge_orphans(self.kindle)
+            self.status("Removed %d collection items of missing books" % removed)
+        dialog.destroy()
+
+    def purge_orphans_prompt(self, orphans):
+        lines = ["%s: %d" % (collection, len(orphans[collection])) for collection in sorted(orphans)]
+        total = sum(len(items) for items in orphans.itervalues())
+        label = gtk.Label("Remove %d items of books missing from the Kindle?\n\n%s" % (total, '\n'.join(lines)))
+        dialog = gtk.Dialog("Remove missing books",
+                    self.window,
+                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                    (gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT,
+                    gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+        dialog.vbox.pack_start(label)
+        dialog.show_all()
+        return dialog
+
+    # Lists identical copies of books, offering to keep only the first in collections
+    def find_duplicates(self, widget):
+        self.status("Looking for duplicate books... please wait")
+        # Candidates are read in full, hash them off the main loop as a scan
+        self.scan(lambda progress: self.kindle.find_duplicates(), self.duplicates_found)
+
+    def duplicates_found(self, duplicates):
+        if not duplicates:
+            self.status("No duplicate books found")
+            return
+        dialog = self.duplicates_prompt(duplicates)
+        if dialog.run() == gtk.RESPONSE_ACCEPT:
+            removed = self.db.merge_duplicates(duplicates)
+            self.colmodel.clear()
+            self.get_collections()
+            self.colview.expand_all()
+            self.status("Removed %d collection items of duplicate books" % removed)
+        else:
+            self.status("%d duplicate books found" % len(duplicates))
+        dialog.destroy()
+
+    def duplicates_prompt(self, duplicates):
+        lines = list()
+        for books in duplicates:
+            lines.append(self.get_filename(books[0]))
+            lines.extend("    %s" % book.path for book in books)
+        label = gtk.Label("Use only the first copy of these books in collections?")
+        copies = gtk.TextView()
+        copies.set_editable(False)
+        copies.get_buffer().set_text('\n'.join(kindle.encode(line) for line in lines))
+        scroll = gtk.ScrolledWindow()
+        scroll.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scroll.set_size_request(600, 300)
+        scroll.add(copies)
+        dialog = gtk.Dialog("Duplicate books",
+                    self.window,
+                    gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                    (gtk.STOCK_CANCEL, gtk.RESPONSE_REJECT,
+                    gtk.STOCK_OK, gtk.RESPONSE_ACCEPT))
+        dialog.vbox.pack_start(label, False)
+        dialog.vbox.pack_start(scroll)
+        dialog.show_all()
+        return dialog
+
     def rename_collection(self, widget):
         (colstore, rows) = self.colview.get_selection().get_selected_rows()
         collections = list()
@@ -209,17 +365,17 @@ class KindleUI:
                 collections.append(gtk.TreeRowReference(colstore, row))
         if len(collections) == 1:
             colrow = colstore[collections[0].get_path()]
-            colname = colrow[0]
+            # The model returns UTF-8, the database is keyed by unicode
+            colname = kindle.decode(colrow[0])
             (dialog, input_box) = self.collection_prompt("Add Collection", "New Collection name:")
             input_box.set_text(colname)
             dialog.show_all()
             newname = ""
             if dialog.run() == gtk.RESPONSE_ACCEPT:
-                newname = input_box.get_text().strip()
+                newname = kindle.decode(input_box.get_text().strip())
                 if not newname == colname and colname in self.db:
                     colrow[0] = newname
-                    self.db[newname] = self.db[colname]
-                    del self.db[colname]
+                    self.db.rename_collection(colname, newname)
             else:
                 self.statusbar.pop(1)
             dialog.destroy()
@@ -254,25 +410,26 @@ class KindleUI:
             gtkrow = gtk.TreeRowReference(filestore, row)
             filerow = self.get_path_value(filestore, gtkrow)
             if filerow[1] == "":
-                piter = filestore.get_iter(gtkrow.get_path())
-                citer = filestore.iter_children(piter)
-                if citer:
-                    subrow = filestore.get_path(citer)
-                    subhashes = self.get_hashes(filestore, [subrow])
-                    for subhash in subhashes:
-                        filehashes.append(subhash)
-
-                    niter = filestore.iter_next(citer)
-                    while niter:
-                        nextrow = filestore.get_path(niter)
-                        subhashes = self.get_hashes(filestore, [nextrow])
-                        for subhash in subhashes:
-                            filehashes.append(subhash)
-                        niter = filestore.iter_next(niter)
+                # Folder rows may not be populated yet, their files come from the filetree
+                folder = kindle.decode(filestore.get_value(filestore.get_iter(gtkrow.get_path()), 3))
+                if folder:
+                    filehashes.extend(self.get_tree_files(self.get_subtree(folder), folder))
             else:
                 filehashes.append((filerow[0], filerow[1]))
         return filehashes
 
+    # Returns (filename, filehash) for every file below a filetree node
+    def get_tree_files(self, tree, path):
+        filehashes = list()
+        for node in tree:
+            if node == 'files':
+                for filename in tree['files']:
+                    filehash = self.kindle.paths[kindle.KINDLEROOT + '/'.join([path, filename])]
+                    filehashes.append((self.get_title(filehash, filename), filehash))
+            else:
+                filehashes.extend(self.get_tree_files(tree[node], '/'.join([path, node])))
+        return filehashes
+
     def add_file(self, widget):
         self.statusbar.pop(1)
         (filestore, filerows) = self.fileview.get_selection().get_selected_rows()
@@ -293,48 +450,75 @@ class KindleUI:
         if len(targetcols) == 0:
             self.status("Select a target collection to add")
 
-        filehashes = self.get_hashes(filestore, filerows)
-        for filename, filehash in filehashes:
-            for colpath, colname in targetcols:
-                colname = unicode(colname)
-                if colname in self.db:
-                    try:
-                        asin = self.kindle.files[filehash].asin
-                        if not self.db.in_collection(colname, asin):
-                            colstore.append(colstore[colpath].iter, [filename, filehash, asin])
-                            self.db.add_asin(colname, self.kindle.files[filehash].asin, self.kindle.files[filehash].type)
-                    except TypeError:
-                        if not self.db.in_collection(colname, filehash):
-                            colstore.append(colstore[colpath].iter, [filename, filehash, ""])
-                            self.db.add_filehash(colname, filehash)
-                else:
-                    self.status("No such collection:" + colname)
-        #self.colview.expand_all()
+        filenames = dict()
+        books = list()
+        for filename, filehash in self.get_hashes(filestore, filerows):
+            if not filehash in filenames:
+                filenames[filehash] = filename
+                books.append(self.kindle.files[filehash])
+        coliters = dict()
+        for colpath, colname in targetcols:
+            colname = unicode(colname)
+            if colname in self.db:
+                coliters[colname] = colstore[colpath].iter
+            else:
+                self.status("No such collection:" + colname)
+        added = self.db.add_many(coliters.keys(), books)
+        with self.detached(self.colview, len(added)):
+            for colname, book in added:
+                colstore.append(coliters[colname], [filenames[book.hash], book.hash, book.asin or ""])
 
     def del_file(self, widget):
         self.statusbar.pop(1)
         (colstore, rows) = self.colview.get_selection().get_selected_rows()
-        ref = list()
+        # Selected books by collection row
+        selected = dict()
         for row in rows:
             if len(row) == 2:
-                ref.append(gtk.TreeRowReference(colstore, row))
-        for row in range(len(ref)):
-            gtkrow = ref[row]
-            path = gtkrow.get_path()
-            (filename, filehash, asin) = self.get_colpath_value(colstore, gtkrow)
-            collection = unicode(self.get_colpath_value(colstore, (path[0], ))[0])
-            if asin and asin != '':
-                book = self.kindle.searchAsin(asin)
-                asin = "#%s^%s" % (book.asin, book.type)
-                if self.db[collection].has_hash(asin):
-                    self.db[collection]['items'].remove(asin)
-                    colstore.remove(colstore[path].iter)
-            elif self.db[collection].has_hash(filehash):
-                jsonhash = '*' + filehash
-                self.db[collection]['items'].remove(jsonhash)
-                colstore.remove(colstore[path].iter)
-            else:
-                self.status("File not in collection")
+                filehash = colstore.get_value(colstore.get_iter(row), 1)
+                if filehash in self.kindle.files:
+                    selected.setdefault(row[0], list()).append(self.kindle.files[filehash])
+        removed = list()
+        with self.db.operation():
+            for colpath, books in selected.iteritems():
+                citer = colstore.get_iter((colpath, ))
+                collection = unicode(colstore.get_value(citer, 0))
+                hashes = set(book.hash for colname, book in self.db.remove_many([collection], books))
+                # A book can have rows for both its ASIN and hash items
+                child = colstore.iter_children(citer)
+                while child:
+                    if colstore.get_value(child, 1) in hashes:
+                        removed.append(child)
+                    child = colstore.iter_next(child)
+        if selected and not removed:
+            self.status("File not in collection")
+        with self.detached(self.colview, len(removed)):
+            for child in removed:
+                colstore.remove(child)
+
+    @contextlib.contextmanager
+    def detached(self, treeview, rows):
+        '''Detaches the model of treeview while changing more than
+        DETACH_ROWS rows, restoring its expanded rows and selection
+        '''
+        if rows <= DETACH_ROWS:
+            yield
+            return
+        model = treeview.get_model()
+        expanded = list()
+        treeview.map_expanded_rows(lambda view, path: expanded.append(path))
+        selection = treeview.get_selection()
+        selected = [gtk.TreeRowReference(model, path) for path in selection.get_selected_rows()[1]]
+        treeview.set_model(None)
+        try:
+            yield
+        finally:
+            treeview.set_model(model)
+            for path in expanded:
+                treeview.expand_to_path(path)
+            for ref in selected:
+                if ref.valid():
+                    selection.select_path(ref.get_path())
 
     def get_view(self, title, model, name):
         treeview = gtk.TreeView(model)
@@ -352,6 +536,72 @@ class KindleUI:
         tvcolumn.set_sort_column_id(0)
         return treeview
 
+    def undo(self, widget):
+        steps = self.db.undo()
+        if steps is None:
+            self.status("Nothing to undo")
+        else:
+            self.update_collections(steps)
+            self.status("Undone")
+
+    def redo(self, widget):
+        steps = self.db.redo()
+        if steps is None:
+            self.status("Nothing to redo")
+        else:
+            self.update_collections(steps)
+            self.status("Redone")
+
+    # Updates the collection rows changed by CollectionDB journal steps
+    def update_collections(self, steps):
+        rows = sum(len(step[2]) for step in steps if step[0] in ('insert', 'remove'))
+        with self.detached(self.colview, rows):
+            for step in steps:
+                action, collection = step[:2]
+                citer = self.get_collection_iter(collection)
+                # Steps of a collection without a row have nothing to update
+                if citer is None and action != 'set':
+                    continue
+                if action == 'insert':
+                    for index, item in step[2]:
+                        self.add_item_row(citer, collection, item)
+                elif action == 'remove':
+                    self.remove_item_rows(citer, [item for index, item in step[2]])
+                elif action == 'set':
+                    if citer:
+                        self.colmodel.remove(citer)
+                    citer = self.add_collection_rows(collection)
+                    self.colview.expand_row(self.colmodel.get_path(citer), False)
+                elif action == 'delete':
+                    self.colmodel.remove(citer)
+
+    def get_collection_iter(self, collection):
+        citer = self.colmodel.get_iter_first()
+        while citer:
+            if kindle.decode(self.colmodel.get_value(citer, 0)) == collection:
+                return citer
+            citer = self.colmodel.iter_next(citer)
+        return None
+
+    # Removes a row for each item of a collection shown in the view
+    def remove_item_rows(self, citer, items):
+        counts = dict()
+        for item in items:
+            key = kindle.get_item_key(item)
+            book = self.kindle.files.get(key) or self.kindle.searchAsin(key)
+            if book:
+                counts[book.hash] = counts.get(book.hash, 0) + 1
+        removed = list()
+        child = self.colmodel.iter_children(citer)
+        while child:
+            filehash = self.colmodel.get_value(child, 1)
+            if counts.get(filehash):
+                counts[filehash] -= 1
+                removed.append(child)
+            child = self.colmodel.iter_next(child)
+        for child in removed:
+            self.colmodel.remove(child)
+
     def revert(self, widget):
         self.db = kindle.CollectionDB(self.colfile)
         self.colmodel.clear()
@@ -360,43 +610,141 @@ class KindleUI:
         self.status("Kindle collections reloaded")
 
     def save(self, widget):
-        now = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-        backup = os.path.join(self.root, 'system', '%s-collections.json.backup' % (now))
-        jsonfile = os.path.join(self.root, 'system', 'collections.json')
-        if os.path.exists(jsonfile):
-            os.rename(jsonfile, backup)
-        with open(os.path.join(self.root, 'system', 'collections.json'), 'wb') as colfile:
-            json.dump(self.db.toKindleDb(), colfile, separators=(',', ':'), ensure_ascii=True)
-        self.status("Collections saved to Kindle, restart to load your new collections")
-
-    def get_filenodes(self, tree, nodes):
-        if len(nodes) > 1:
-            if not nodes[0] in tree:
-                tree[nodes[0]] = dict()
-            self.get_filenodes(tree[nodes[0]], nodes[1:])
-        elif len(nodes) == 1:
-            if not 'files' in tree:
-                tree['files'] = list()
-            tree['files'].append(nodes[0])
+        if self.db.save(os.path.join(self.root, 'system', 'collections.json')):
+            self.status("Collections saved to Kindle, restart to load your new collections")
+        else:
+            self.status("No changes to save")
 
+    # Adds the rows for one level of the filetree, folders get a placeholder
+    # child until they are expanded
     def get_files(self, filemodel, tree, piter=None, path=""):
         for node in tree:
             if node == 'files':
                 for filename in tree['files']:
-                    filehash = kindle.get_hash('/mnt/us' + '/'.join([path, filename]))
-                    if filehash in self.kindle.files and self.kindle.files[filehash].title:
-                        filename = self.kindle.files[filehash].title
-                    filemodel.append(piter, [filename, filehash, False])
+                    filehash = self.kindle.paths[kindle.KINDLEROOT + '/'.join([path, filename])]
+                    filename = self.get_title(filehash, filename)
+                    self.fileiters[filehash] = filemodel.append(piter, [filename, filehash, False, ""])
             else:
-                niter = filemodel.append(piter, [node, "", False])
-                self.get_files(filemodel, tree[node], niter, '/'.join([path,node]))
-
-    def refresh(self, widget):
-        self.kindle.init_data()
+                self.add_folder(filemodel, piter, node, '/'.join([path, node]))
+        self.loaded.add(path)
+
+    def add_folder(self, filemodel, piter, node, path):
+        niter = filemodel.append(piter, [node, "", False, path])
+        filemodel.append(niter, ["", "", False, ""])
+        self.folderiters[path] = niter
+        return niter
+
+    # Populates a folder the first time it is expanded
+    def expand_folder(self, treeview, titer, treepath):
+        # Filetree paths are unicode, the model returns UTF-8
+        path = kindle.decode(self.filemodel.get_value(titer, 3))
+        if path and not path in self.loaded:
+            self.filemodel.remove(self.filemodel.iter_children(titer))
+            with self.kindle.lock, instrument.phase('model'):
+                self.get_files(self.filemodel, self.get_subtree(path), titer, path)
+        return False
+
+    # Returns the filetree node of a folder path, None if it is gone
+    def get_subtree(self, path):
+        tree = self.kindle.filetree
+        for node in path.split('/')[1:]:
+            tree = tree.get(node)
+            if tree is None:
+                break
+        return tree
+
+    def get_title(self, filehash, filename):
+        if filehash in self.kindle.files and self.kindle.files[filehash].title:
+            return self.kindle.files[filehash].title
+        return filename
+
+    # Rebuilds the file list from the last full scan
+    def fill_files(self):
+        # TreeStore iters stay valid while their row exists
+        self.fileiters = dict()
+        self.folderiters = dict()
+        self.loaded = set()
         self.filemodel.clear()
         self.get_files(self.filemodel, self.kindle.filetree)
-        self.fileview.expand_all()
-        self.status("File list refreshed")
+        self.index = search.SearchIndex(self.kindle.files.itervalues())
+        self.search(self.search_entry)
+
+    # Lists the files matching the search box in place of the folder tree
+    def search(self, widget):
+        query = widget.get_text().decode('utf-8').strip()
+        if not query:
+            if self.fileview.get_model() is not self.filemodel:
+                self.fileview.set_model(self.filemodel)
+                for ref in self.expanded:
+                    if ref.valid():
+                        self.fileview.expand_to_path(ref.get_path())
+            return
+        if self.fileview.get_model() is self.filemodel:
+            self.expanded = list()
+            self.fileview.map_expanded_rows(lambda view, path: self.expanded.append(gtk.TreeRowReference(self.filemodel, path)))
+        books = [self.kindle.files[filehash] for filehash in self.index.search(query)]
+        books.sort(key=self.get_filename)
+        results = gtk.ListStore(str, str, bool, str)
+        for book in books:
+            results.append([self.get_filename(book), book.hash, False, ""])
+        self.fileview.set_model(results)
+        self.status("%d files found" % len(books))
+
+    # Applies a kindle.ChangeSet to the populated rows of the file list
+    def update_files(self, changes):
+        self.index.update(changes)
+        for book in changes.removed:
+            fiter = self.fileiters.pop(book.hash, None)
+            if fiter:
+                self.filemodel.remove(fiter)
+        self.prune_folders()
+        for book in changes.modified:
+            if book.hash in self.fileiters:
+                self.filemodel.set_value(self.fileiters[book.hash], 0, self.get_filename(book))
+        for book in changes.added:
+            # Folders expanded during a scan are filled from the filetree,
+            # which can hold books of batches not delivered yet
+            if book.hash in self.fileiters:
+                continue
+            piter = self.get_folder_iter(self.kindle.get_nodes(book)[:-1])
+            if piter:
+                self.fileiters[book.hash] = self.filemodel.append(piter, [self.get_filename(book), book.hash, False, ""])
+
+    def get_filename(self, book):
+        if book.title:
+            return book.title
+        return os.path.basename(book.path)
+
+    # Returns the row of a populated folder, adding folder rows below
+    # populated parents as needed, or None if the folder isn't populated
+    def get_folder_iter(self, nodes):
+        piter = None
+        path = ""
+        for node in nodes:
+            path = '/'.join([path, node])
+            if not path in self.folderiters:
+                self.add_folder(self.filemodel, piter, node, path)
+            if not path in self.loaded:
+                return None
+            piter = self.folderiters[path]
+        return piter
+
+    # Removes the rows of folders no longer in the filetree
+    def prune_folders(self):
+        for path in sorted(self.folderiters):
+            if path in self.folderiters and self.get_subtree(path) is None:
+                self.filemodel.remove(self.folderiters[path])
+                for folder in self.folderiters.keys():
+                    if folder == path or folder.startswith(path + '/'):
+                        del self.folderiters[folder]
+                        self.loaded.discard(folder)
+
+    def refresh(self, widget):
+        self.scan(self.kindle.refresh, self.refresh_done)
+
+    def refresh_done(self, changes):
+        self.status("File list refreshed: %d added, %d removed, %d modified" %
+                    (len(changes.added), len(changes.removed), len(changes.modified)))
 
     def open_collection(self, widget):
         dialog = gtk.FileChooserDialog("Open a collection", self.window,
@@ -412,5 +760,10 @@ class KindleUI:
             self.revert(widget)
         dialog.destroy()
 
-if __name__ == "__main__":
+def main():
+    gobject.threads_init()
     KindleUI()
+    gtk.main()
+
+if __name__ == "__main__":
+    main()
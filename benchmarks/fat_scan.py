@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Times cold scans of a synthetic Kindle on a loopback FAT32 image, parsing
+in directory order and in disk order with read-ahead, and prints the
+results as JSON. Needs root, mkfs.vfat and losetup on Linux.
+
+    sudo python benchmarks/fat_scan.py --books 5000 --runs 3
+'''
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import kindle
+import schedule
+import synthetic
+from scale import Quiet
+
+def call(*args):
+    return subprocess.check_output(args).strip()
+
+# Empties the page cache so every scan reads from the image
+def drop_caches():
+    call('sync')
+    with open('/proc/sys/vm/drop_caches', 'w') as caches:
+        caches.write('3\n')
+
+def mount(device, mountpoint):
+    call('mount', '-t', 'vfat', device, mountpoint)
+
+def scan(device, mountpoint, workers, ordered):
+    call('umount', mountpoint)
+    drop_caches()
+    mount(device, mountpoint)
+    enabled = schedule.ENABLED
+    schedule.ENABLED = ordered
+    stdout = sys.stdout
+    sys.stdout = Quiet()
+    try:
+        start = time.time()
+        kindle.Kindle(mountpoint, workers).init_data()
+        seconds = time.time() - start
+    finally:
+        sys.stdout = stdout
+        schedule.ENABLED = enabled
+    # Leave the next scan nothing to take from the metadata cache
+    os.remove(os.path.join(mountpoint, 'system', kindle.CACHE_FILE))
+    return seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=512, help="image size in MB")
+    parser.add_argument('--runs', type=int, default=3, help="scans per mode, the fastest is kept")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='kindelabra-fat-')
+    image = os.path.join(folder, 'kindle.img')
+    mountpoint = os.path.join(folder, 'mnt')
+    os.mkdir(mountpoint)
+    device = None
+    try:
+        with open(image, 'wb') as img:
+            img.truncate(args.size << 20)
+        call('mkfs.vfat', '-F', '32', '-n', 'KINDLE', image)
+        # Direct I/O keeps the image itself out of the host page cache
+        device = call('losetup', '--find', '--show', '--direct-io=on', image)
+        mount(device, mountpoint)
+        synthetic.build_tree(mountpoint, args.books)
+        report = {'python': sys.version.split()[0], 'books': args.books, 'workers': args.workers}
+        for name, ordered in [('directory_order', False), ('disk_order', True)]:
+            report[name] = round(min(scan(device, mountpoint, args.workers, ordered) for run in range(args.runs)), 6)
+    finally:
+        subprocess.call(['umount', mountpoint])
+        if device:
+            subprocess.call(['losetup', '-d', device])
+        shutil.rmtree(folder, ignore_errors=True)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results:
+            results.write(output + '\n')
+    else:
+        print output
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Times the scan, collection load and save paths on synthetic Kindle trees
+of increasing size and prints the results as JSON.
+
+    python benchmarks/scale.py --sizes 1000,10000,50000 --output results.json
+'''
+
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import kindle
+import synthetic
+
+class Quiet:
+    '''Swallows the scan progress written to stdout
+    '''
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+def timed(results, name, function, *args):
+    stdout = sys.stdout
+    sys.stdout = Quiet()
+    try:
+        start = time.time()
+        value = function(*args)
+        results[name] = round(time.time() - start, 6)
+    finally:
+        sys.stdout = stdout
+    return value
+
+# Resolves every collection item to a file the way KindleUI.get_collections does
+def resolve_items(device, db):
+    found = 0
+    for collection in db:
+        for namehash in db[collection]['items']:
+            if re.match('\*[\w]', namehash):
+                namehash = str(namehash.lstrip("*"))
+            asin = re.match('\#([\w\-]+)\^\w{4}', namehash)
+            if asin:
+                book = device.searchAsin(asin.group(1))
+                namehash = book.hash if book else None
+            if namehash in device.files:
+                found += 1
+    return found
+
+def add_all(device, db, collections):
+    added = 0
+    for number in range(collections):
+        colname = u'Bulk %d' % number
+        db.add_collection(colname)
+        for book in device.files.itervalues():
+            if db.add_book(colname, book):
+                added += 1
+    return added
+
+def serialize(db):
+    return kindle.encode_collections(db.toKindleDb())
+
+def run(size, args):
+    root = tempfile.mkdtemp(prefix='kindelabra-bench-')
+    results = {'books': size, 'collections': args.collections, 'memberships': size * args.memberships}
+    try:
+        timed(results, 'generate', synthetic.build_tree, root, size, args.collections, size * args.memberships)
+        device = kindle.Kindle(root, args.workers)
+        timed(results, 'init_data_cold', device.init_data)
+        device = kindle.Kindle(root, args.workers)
+        timed(results, 'init_data_cached', device.init_data)
+        timed(results, 'refresh_unchanged', device.refresh)
+        colfile = os.path.join(root, 'system', 'collections.json')
+        db = timed(results, 'collections_load', kindle.CollectionDB, colfile)
+        results['resolved_items'] = timed(results, 'resolve_items', resolve_items, device, db)
+        results['added_items'] = timed(results, 'bulk_add', add_all, device, db, args.bulk)
+        data = timed(results, 'serialize', serialize, db)
+        results['json_bytes'] = len(data)
+        timed(results, 'save', db.save, colfile)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,50000', help="comma separated book counts")
+    parser.add_argument('--collections', type=int, default=50)
+    parser.add_argument('--memberships', type=int, default=1, help="collection items per book")
+    parser.add_argument('--bulk', type=int, default=3, help="collections every book is added to")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0], 'workers': args.workers, 'runs': list()}
+    for size in args.sizes.split(','):
+        report['runs'].append(run(int(size), args))
+        sys.stderr.write("%s books done\n" % size)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results:
+            results.write(output + '\n')
+    else:
+        print output
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Times importing each module and opening the main window, each in a fresh
+interpreter, and prints the results as JSON.
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['instrument', 'kindle', 'ebook', 'search', 'kindelabra_cli', 'Kindelabra']
+# Imports that only some operations need, reported when a module pulls them in
+HEAVY = ['gtk', 'multiprocessing', 'zipfile', 'ebook']
+
+IMPORT = '''
+import sys, time, json
+sys.path.insert(0, %(root)r)
+start = time.time()
+import %(module)s
+seconds = time.time() - start
+print json.dumps({'seconds': seconds, 'modules': len(sys.modules),
+                  'heavy': [name for name in %(heavy)r if name in sys.modules]})
+'''
+
+WINDOW = '''
+import sys, time, os, json
+start = float(os.environ['KINDELABRA_STARTED'])
+sys.path.insert(0, %(root)r)
+import gobject
+import gtk
+import Kindelabra
+imported = time.time() - start
+def painted(widget, event):
+    print json.dumps({'imported': imported, 'window': time.time() - start})
+    gtk.main_quit()
+gobject.threads_init()
+ui = Kindelabra.KindleUI()
+ui.window.connect('expose-event', painted)
+gtk.main()
+'''
+
+def run(script, env=None):
+    process = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=env)
+    out, err = process.communicate()
+    if process.returncode:
+        return None, err.strip().splitlines()[-1] if err.strip() else 'exit %d' % process.returncode
+    return json.loads(out.strip().splitlines()[-1]), None
+
+def time_import(module, runs):
+    results = list()
+    for number in range(runs):
+        result, error = run(IMPORT % {'root': ROOT, 'module': module, 'heavy': HEAVY})
+        if error:
+            return {'error': error}
+        results.append(result)
+    best = min(results, key=lambda result: result['seconds'])
+    return {'seconds': round(best['seconds'], 6), 'modules': best['modules'], 'heavy': best['heavy']}
+
+def time_window(runs):
+    results = list()
+    for number in range(runs):
+        env = dict(os.environ, KINDELABRA_STARTED=repr(time.time()))
+        result, error = run(WINDOW % {'root': ROOT}, env)
+        if error:
+            return {'error': error}
+        results.append(result)
+    best = min(results, key=lambda result: result['window'])
+    return {'imported': round(best['imported'], 6), 'window': round(best['window'], 6)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters per measurement, the fastest is kept")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0], 'runs': args.runs, 'imports': dict()}
+    for module in MODULES:
+        report['imports'][module] = time_import(module, args.runs)
+    # Seconds from launching the interpreter to the first paint of the window
+    report['time_to_window'] = time_window(args.runs)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results:
+            results.write(output + '\n')
+    else:
+        print output
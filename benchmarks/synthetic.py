@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Builders for synthetic ebook files in the formats Kindelabra parses
+'''
+
+import StringIO
+import hashlib
+import json
+import os
+import random
+import struct
+import zipfile
+
+# Encodes a Topaz variable width integer
+def vwi(value):
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return ''.join(chr(b) for b in reversed(out))
+
+# Returns a MOBI file with EXTH 113 (ASIN), 501 (CDE type) and 503 (title)
+def mobi(title, asin=None, cdetype='EBOK', exth_title=None, padding=0):
+    records = list()
+    if asin:
+        records.append((113, asin))
+    if cdetype:
+        records.append((501, cdetype))
+    if exth_title:
+        records.append((503, exth_title))
+    records.append((100, 'Kindelabra'))
+    if padding:
+        records.append((103, 'x' * padding))
+    body = ''.join(struct.pack('>LL', rectype, len(data) + 8) + data for rectype, data in records)
+    exth = 'EXTH' + struct.pack('>LL', len(body) + 12, len(records)) + body
+
+    len_mobi = 232
+    mobi_header = bytearray(len_mobi)
+    mobi_header[0:4] = 'MOBI'
+    struct.pack_into('>L', mobi_header, 4, len_mobi)
+    titleoffset = 16 + len_mobi + len(exth)
+    struct.pack_into('>LL', mobi_header, 84 - 16, titleoffset, len(title))
+    struct.pack_into('>L', mobi_header, 0x80 - 16, 0x40)
+    record0 = '\0' * 16 + str(mobi_header) + exth + title + '\0' * 4
+    text = 'text ' * 40
+
+    num_sections = 2
+    header = bytearray(78)
+    header[0:len(title[:31])] = title[:31]
+    header[0x3C:0x44] = 'BOOKMOBI'
+    struct.pack_into('>H', header, 76, num_sections)
+    start = 78 + num_sections * 8 + 2
+    offsets = [start, start + len(record0)]
+    table = ''.join(struct.pack('>LL', offset, uid) for uid, offset in enumerate(offsets))
+    return str(header) + table + '\0\0' + record0 + text
+
+# Returns a Topaz file with a metadata record and pages page records
+def topaz(title, asin, cdetype='EBOK', pages=200):
+    metadata = [('Title', title), ('ASIN', asin), ('CDEType', cdetype), ('Authors', 'Kindelabra')]
+    md_block = vwi(8) + 'metadata' + chr(0) + chr(len(metadata))
+    for tag, value in metadata:
+        md_block += vwi(len(tag)) + tag + vwi(len(value)) + value
+    page = 'p' * 512
+    blocks = [(len(md_block) + i * len(page), len(page), 0) for i in range(pages)]
+    headers = [('metadata', [(0, len(md_block), 0)]), ('page', blocks)]
+
+    header = 'TPZ0' + vwi(len(headers))
+    for tag, tagblocks in headers:
+        header += 'c' + vwi(len(tag)) + tag + vwi(len(tagblocks))
+        for block in tagblocks:
+            header += ''.join(vwi(value) for value in block)
+    header += 'd'
+    return header + md_block + page * pages
+
+# Returns an azw2 Kindlet, a jar with the title and ASIN in its manifest
+def kindlet(title, asin=None):
+    manifest = 'Manifest-Version: 1.0\r\nImplementation-Title: %s\r\n' % title
+    if asin:
+        manifest += 'Amazon-ASIN: %s\r\n' % asin
+    data = StringIO.StringIO()
+    jar = zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED)
+    jar.writestr('META-INF/MANIFEST.MF', manifest)
+    jar.writestr('Main.class', 'class ' * 200)
+    jar.close()
+    return data.getvalue()
+
+def build_tree(root, books, collections=10, memberships=None, depth=3, seed=0):
+    '''Writes a Kindle tree under root with books files spread over nested
+    folders, and a collections.json spreading memberships items over
+    collections. Returns (Kindle path, ASIN, CDE type) for each book.
+    '''
+    rand = random.Random(seed)
+    if memberships is None:
+        memberships = books
+    folders = ['documents']
+    for level in range(depth):
+        for folder in list(folders):
+            if folder.count('/') == level:
+                folders.extend('%s/shelf%d' % (folder, i) for i in range(3))
+    folders.append('pictures/comics')
+    for folder in folders + ['system']:
+        path = os.path.join(root, folder)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    library = list()
+    for number in range(books):
+        folder = rand.choice(folders)
+        asin = 'B%09d' % number
+        kind = number % 10
+        if kind < 7:
+            filename = 'book%d.mobi' % number
+            if kind == 6:
+                # Personal document without an ASIN
+                asin = None
+                data = mobi('Book %d' % number, cdetype='PDOC')
+            else:
+                data = mobi('Book %d' % number, asin, exth_title='The Long Title of Book %d' % number)
+        elif kind < 9:
+            filename = 'book%d.azw1' % number
+            data = topaz('Topaz %d' % number, asin, pages=20)
+        else:
+            filename = 'app%d.azw2' % number
+            data = kindlet('App %d' % number, asin)
+        with open(os.path.join(root, folder, filename), 'wb') as book:
+            book.write(data)
+        library.append(('/mnt/us/%s/%s' % (folder, filename), asin, 'AZW2' if kind == 9 else 'EBOK'))
+
+    tmpjson = dict()
+    for number in range(collections):
+        tmpjson['Collection %d@en-US' % number] = {'items': list(), 'lastAccess': 1300000000 + number}
+    keys = sorted(tmpjson)
+    for number in range(memberships):
+        path, asin, cdetype = rand.choice(library)
+        if asin:
+            item = '#%s^%s' % (asin, cdetype)
+        else:
+            item = '*' + hashlib.sha1(path).hexdigest()
+        tmpjson[keys[number % len(keys)]]['items'].append(item)
+    with open(os.path.join(root, 'system', 'collections.json'), 'wb') as colfile:
+        json.dump(tmpjson, colfile, separators=(',', ':'))
+    return library
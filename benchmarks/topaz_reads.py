@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Counts the seek and read calls made while parsing a Topaz header with
+the seek-per-slice StreamSlicer and with the BufferedSlicer.
+
+Files are opened unbuffered, so each call is one system call.
+'''
+
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ebook
+import synthetic
+
+class CountingFile(object):
+    calls = {'seek': 0, 'read': 0}
+
+    def __init__(self, filename, mode='rb'):
+        self.f = open(filename, mode, 0)
+        self.name = filename
+
+    def seek(self, *args):
+        CountingFile.calls['seek'] += 1
+        return self.f.seek(*args)
+
+    def read(self, *args):
+        CountingFile.calls['read'] += 1
+        return self.f.read(*args)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+def measure(filename, slicer, repeat=20):
+    ebook.Topaz.slicer = slicer
+    ebook.open = CountingFile
+    try:
+        CountingFile.calls.update(seek=0, read=0)
+        book = ebook.Topaz(filename)
+        calls = dict(CountingFile.calls)
+        seconds = min(timeit.repeat(lambda: ebook.Topaz(filename), number=1, repeat=repeat))
+    finally:
+        del ebook.open
+        ebook.Topaz.slicer = ebook.BufferedSlicer
+    return book, calls, seconds
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    fd, filename = tempfile.mkstemp(suffix='.tpz')
+    os.write(fd, synthetic.topaz('Benchmark', 'B000000000', pages=pages))
+    os.close(fd)
+    try:
+        results = list()
+        for slicer in (ebook.StreamSlicer, ebook.BufferedSlicer):
+            book, calls, seconds = measure(filename, slicer)
+            results.append((book.title, book.asin, book.type))
+            print "%-15s seeks: %5d  reads: %5d  %.3f ms" % (slicer.__name__, calls['seek'], calls['read'], seconds * 1000)
+        assert results[0] == results[1]
+    finally:
+        os.remove(filename)
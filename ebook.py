@@ -7,66 +7,166 @@
 # (http://creativecommons.org/licenses/GPL/2.0/)
 
 import struct
+import zlib
 
-import zipfile
-import re
+import instrument
+
+# Bytes of record 0 read up front, enough for the MOBI header and a typical EXTH block
+HEADER_CHUNK = 4096
 
 class Sectionizer:
-    def __init__(self, filename, perm):
-        self.f = file(filename, perm)
-        header = self.f.read(78)
+    '''Locates record 0 of a PDB file from its header and the first two
+    entries of the section table, without reading the rest of the table
+    '''
+    def __init__(self, f):
+        self.f = f
+        header = f.read(78)
+        if len(header) < 78:
+            raise ValueError('truncated file')
         self.ident = header[0x3C:0x3C+8]
         if self.ident != 'BOOKMOBI':
             raise ValueError('invalid file format')
         num_sections, = struct.unpack_from('>H', header, 76)
-        sections = self.f.read(num_sections*8)
-        self.sections = struct.unpack_from('>%dL' % (num_sections*2), sections, 0)[::2] + (0xfffffff, )
+        if num_sections == 0:
+            raise ValueError('no sections')
+        count = min(num_sections, 2)
+        sections = f.read(count*8)
+        offsets = struct.unpack_from('>%dL' % (count*2), sections, 0)[::2]
+        self.start = offsets[0]
+        if count == 2:
+            self.end = offsets[1]
+        else:
+            f.seek(0, 2)
+            self.end = f.tell()
 
-    def loadSection(self, section):
-        before, after = self.sections[section:section+2]
-        self.f.seek(before)
-        return self.f.read(after - before)
+    def readRecord(self, data, size):
+        '''Extends data, the start of record 0, to size bytes
+        '''
+        size = min(size, self.end - self.start)
+        if size > len(data):
+            self.f.seek(self.start + len(data))
+            data += self.f.read(size - len(data))
+        return data
+
+def read_exth(data, start, end, wanted=None):
+    '''Returns the EXTH records between offsets start and end of data by
+    type, the last record of a repeated type winning. With a wanted set of
+    types only those are kept.
+    '''
+    exth = dict()
+    pos = start + 12
+    end = min(end, len(data))
+    while pos + 8 < end:
+        rectype, reclen = struct.unpack_from('>LL', data, pos)
+        # A record shorter than its own header or running past the block is corrupt
+        if reclen < 8 or pos + reclen > end:
+            break
+        if wanted is None or rectype in wanted:
+            exth[rectype] = data[pos+8:pos+reclen]
+        pos += reclen
+    return exth
 
 class Mobi:
-    def __init__(self, filename):
+    def __init__(self, filename, wanted=None):
         try:
-            sections = Sectionizer(filename, 'rb')
-            header = sections.loadSection(0)
-            len_mobi = struct.unpack_from('>L', header, 20)[0] + 16
-            mobi_raw = header[:len_mobi]
-            titleoffset, titlelen = struct.unpack_from('>LL', mobi_raw, 84)
+            with instrument.wrap(open(filename, 'rb')) as f:
+                sections = Sectionizer(f)
+                header = sections.readRecord('', HEADER_CHUNK)
+                len_mobi = struct.unpack_from('>L', header, 20)[0] + 16
+                titleoffset, titlelen = struct.unpack_from('>LL', header, 84)
+                header = sections.readRecord(header, len_mobi + 12)
+                len_exth = 0
+                if header[len_mobi:len_mobi+4] == 'EXTH':
+                    len_exth, = struct.unpack_from('>L', header, len_mobi+4)
+                header = sections.readRecord(header, max(len_mobi + len_exth, titleoffset + titlelen))
             self.title = header[titleoffset:titleoffset+titlelen]
-            len_exth, = struct.unpack_from('>L', header, len_mobi+4)
-            exth_records = header[len_mobi:len_mobi+len_exth][12:]
-            self.exth = dict()
-            while len(exth_records) > 8:
-                rectype, reclen = struct.unpack_from('>LL', exth_records)
-                recdata = exth_records[8:reclen]
-                self.exth[rectype] = recdata
-                exth_records = exth_records[reclen:]
-        except ValueError:
+            self.exth = read_exth(header, len_mobi, len_mobi + len_exth, wanted)
+        except (ValueError, struct.error):
             self.title = None
 
 '''Kindlet metadata parsing
 '''
+MANIFEST = 'META-INF/MANIFEST.MF'
+# Compression methods, as in zipfile
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+# End of central directory record, and the most it can be followed by
+EOCD_SIZE = 22
+MAX_COMMENT = 65535
+
+def read_manifest(f):
+    '''Reads the manifest of a jar from its central directory entry alone.
+    Returns None on anything unusual (zip64, multiple disks, encryption,
+    other compression methods, data before the archive, a CRC mismatch),
+    leaving it to zipfile.
+    '''
+    f.seek(0, 2)
+    size = f.tell()
+    tail = min(size, EOCD_SIZE + MAX_COMMENT)
+    f.seek(size - tail)
+    data = f.read(tail)
+    pos = data.rfind('PK\x05\x06')
+    if pos < 0 or pos + EOCD_SIZE > len(data):
+        return None
+    disk, cddisk, entries_disk, entries, cdsize, cdoffset = struct.unpack_from('<4H2L', data, pos + 4)
+    eocd = size - tail + pos
+    if disk or cddisk or entries != entries_disk or cdoffset + cdsize != eocd:
+        return None
+    f.seek(cdoffset)
+    directory = f.read(cdsize)
+    name = directory.find(MANIFEST)
+    while name >= 0:
+        entry = name - 46
+        if entry >= 0 and directory[entry:entry+4] == 'PK\x01\x02':
+            (flags, method, crc, csize, usize,
+             namelen, offset) = struct.unpack_from('<4x4x2H4x3LH12xL', directory, entry)
+            if namelen == len(MANIFEST):
+                break
+        name = directory.find(MANIFEST, name + 1)
+    else:
+        return None
+    if flags & 0x1 or not method in (ZIP_STORED, ZIP_DEFLATED):
+        return None
+    if 0xFFFFFFFF in (csize, usize, offset):
+        return None
+    f.seek(offset)
+    local = f.read(30)
+    if len(local) < 30 or local[:4] != 'PK\x03\x04':
+        return None
+    namelen, extralen = struct.unpack_from('<2H', local, 26)
+    f.seek(offset + 30 + namelen + extralen)
+    manifest = f.read(csize)
+    if method == ZIP_DEFLATED:
+        manifest = zlib.decompressobj(-zlib.MAX_WBITS).decompress(manifest)
+    if len(manifest) != usize or zlib.crc32(manifest) & 0xffffffff != crc:
+        return None
+    return manifest
+
 class Kindlet:
     def __init__(self, filename):
         # For official apps, ASIN is stored in the Amazon-ASIN field of META-INF/MANIFEST.MF, and title in the Implementation-Title field
-        kindlet = zipfile.ZipFile( filename, 'r')
-        kdkmanifest = kindlet.read( 'META-INF/MANIFEST.MF' )
-        # Catch Title
-        kdktitlem = re.search( '(^Implementation-Title: )(.*?$)', kdkmanifest, re.MULTILINE )
-        if kdktitlem and kdktitlem.group(2):
-            self.title = kdktitlem.group(2).strip()
-        else:
-            self.title = None
-        # Catch ASIN
-        kdkasinm = re.search( '(^Amazon-ASIN: )(.*?$)', kdkmanifest, re.MULTILINE )
-        if kdkasinm and kdkasinm.group(2):
-            self.asin = kdkasinm.group(2).strip()
-        else:
-            self.asin = None
-        kindlet.close()
+        stream = instrument.wrap(open(filename, 'rb'))
+        try:
+            try:
+                kdkmanifest = read_manifest(stream)
+            except (struct.error, zlib.error):
+                kdkmanifest = None
+            if kdkmanifest is None:
+                # Only imported for the archives read_manifest gives up on
+                import zipfile
+                kindlet = zipfile.ZipFile(stream, 'r')
+                kdkmanifest = kindlet.read(MANIFEST)
+                kindlet.close()
+        finally:
+            stream.close()
+        self.title = None
+        self.asin = None
+        # Catch Title and ASIN, the first line with each field wins
+        for line in kdkmanifest.split('\n'):
+            if self.title is None and line.startswith('Implementation-Title: '):
+                self.title = line[22:].strip() or None
+            elif self.asin is None and line.startswith('Amazon-ASIN: '):
+                self.asin = line[13:].strip() or None
 
 '''Topaz metadata parsing. Almost verbatim code by Greg Riker from Calibre
 '''
@@ -100,14 +200,64 @@ class StreamSlicer(object):
             return data
         raise TypeError("stream indices must be integers")
 
+# Bytes fetched per read by BufferedSlicer, enough for most Topaz headers
+TOPAZ_CHUNK = 65536
+
+class BufferedSlicer(StreamSlicer):
+    '''StreamSlicer serving slices from an in-memory window refilled by
+    large reads, instead of a seek and read for every slice
+    '''
+    def __init__(self, stream, start=0, stop=None, chunk=TOPAZ_CHUNK):
+        StreamSlicer.__init__(self, stream, start, stop)
+        self.chunk = chunk
+        self._window = ""
+        self._wstart = 0
+
+    def _slice(self, start, size):
+        offset = start - self._wstart
+        if offset < 0 or offset + size > len(self._window):
+            self._stream.seek(self.start + start)
+            self._window = self._stream.read(max(size, self.chunk))
+            self._wstart = start
+            offset = 0
+        return self._window[offset:offset+size]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long)):
+            if key < 0:
+                key += self._len
+            if not 0 <= key < self._len:
+                return ""
+            return self._slice(key, 1)
+        if isinstance(key, slice):
+            start, stop, stride = key.indices(self._len)
+            if stride < 0:
+                start, stop = stop, start
+            size = stop - start
+            if size <= 0:
+                return ""
+            data = self._slice(start, size)
+            if stride != 1:
+                data = data[::stride]
+            return data
+        raise TypeError("stream indices must be integers")
+
 class Topaz(object):
+    slicer = BufferedSlicer
+
     def __init__(self, filename):
-        self.stream = open(filename, 'rb')
-        self.data = StreamSlicer(self.stream)
+        self.stream = instrument.wrap(open(filename, 'rb'))
+        try:
+            self.data = self.slicer(self.stream)
+            self.parse()
+        finally:
+            self.stream.close()
 
+    def parse(self):
+        name = getattr(self.stream, 'name', 'Unnamed stream')
         sig = self.data[:4]
         if not sig.startswith('TPZ'):
-            raise ValueError("'%s': Not a Topaz file" % getattr(stream, 'name', 'Unnamed stream'))
+            raise ValueError("'%s': Not a Topaz file" % name)
         offset = 4
 
         self.header_records, consumed = self.decode_vwi(self.data[offset:offset+4])
@@ -116,17 +266,16 @@ class Topaz(object):
 
         # First integrity test - metadata header
         if not 'metadata' in self.topaz_headers:
-            raise ValueError("'%s': Invalid Topaz format - no metadata record" % getattr(stream, 'name', 'Unnamed stream'))
+            raise ValueError("'%s': Invalid Topaz format - no metadata record" % name)
 
         # Second integrity test - metadata body
         md_offset = self.topaz_headers['metadata']['blocks'][0]['offset']
         md_offset += self.base
         if self.data[md_offset+1:md_offset+9] != 'metadata':
-            raise ValueError("'%s': Damaged metadata record" % getattr(stream, 'name', 'Unnamed stream'))
+            raise ValueError("'%s': Damaged metadata record" % name)
 
         # Get metadata, and store what we need
         self.title, self.asin, self.type = self.get_metadata()
-        self.stream.close()
 
     def decode_vwi(self,bytes):
         pos, val = 0, 0
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Optional timing and counters for the scan pipeline.
+
+Set KINDELABRA_PROFILE=1 to print a summary to stderr at exit, or to a
+path ending in .json to write the report there. When disabled every hook
+is a flag test or a shared no-op context manager.
+'''
+
+import atexit
+import heapq
+import json
+import os
+import sys
+import threading
+import time
+
+# Slowest files kept in the report
+SLOWEST = 10
+
+ENABLED = False
+REPORT = None
+
+lock = threading.Lock()
+phases = dict()
+counters = dict()
+formats = dict()
+slowest = list()
+current = threading.local()
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL = NullPhase()
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        add_phase(self.name, time.time() - self.started)
+        return False
+
+class CountingFile(object):
+    '''File wrapper adding the bytes read to the file being parsed
+    '''
+    def __init__(self, stream):
+        self._stream = stream
+
+    def read(self, *args):
+        data = self._stream.read(*args)
+        current.bytes = getattr(current, 'bytes', 0) + len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._stream.close()
+        return False
+
+def enable(report=None):
+    global ENABLED, REPORT
+    if not ENABLED:
+        atexit.register(write_report)
+    ENABLED = True
+    REPORT = report
+
+def phase(name):
+    '''Returns a context manager adding its wall time to phase name
+    '''
+    if ENABLED:
+        return Phase(name)
+    return NULL
+
+def add_phase(name, seconds, calls=1):
+    with lock:
+        total = phases.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += calls
+
+def count(name, value=1):
+    if ENABLED:
+        with lock:
+            counters[name] = counters.get(name, 0) + value
+
+def wrap(stream):
+    if ENABLED:
+        return CountingFile(stream)
+    return stream
+
+def file_started():
+    current.bytes = 0
+    return time.time()
+
+def file_done(path, fmt, started):
+    seconds = time.time() - started
+    read = getattr(current, 'bytes', 0)
+    with lock:
+        total = formats.setdefault(fmt, [0.0, 0, 0])
+        total[0] += seconds
+        total[1] += 1
+        total[2] += read
+        entry = (seconds, path, fmt, read)
+        if len(slowest) < SLOWEST:
+            heapq.heappush(slowest, entry)
+        elif entry > slowest[0]:
+            heapq.heapreplace(slowest, entry)
+
+# Returns and clears what was recorded, to send it back from a scan worker
+def take():
+    global phases, counters, formats, slowest
+    if not ENABLED:
+        return None
+    with lock:
+        data = (phases, counters, formats, slowest)
+        phases, counters, formats, slowest = dict(), dict(), dict(), list()
+    return data
+
+def merge(data):
+    if data is None:
+        return
+    other_phases, other_counters, other_formats, other_slowest = data
+    for name, (seconds, calls) in other_phases.iteritems():
+        add_phase(name, seconds, calls)
+    with lock:
+        for name, value in other_counters.iteritems():
+            counters[name] = counters.get(name, 0) + value
+        for fmt, values in other_formats.iteritems():
+            total = formats.setdefault(fmt, [0.0, 0, 0])
+            for i, value in enumerate(values):
+                total[i] += value
+        for entry in other_slowest:
+            if len(slowest) < SLOWEST:
+                heapq.heappush(slowest, entry)
+            elif entry > slowest[0]:
+                heapq.heapreplace(slowest, entry)
+
+def get_report():
+    with lock:
+        return {
+            'phases': dict((name, {'seconds': round(seconds, 6), 'calls': calls})
+                           for name, (seconds, calls) in phases.iteritems()),
+            'counters': dict(counters),
+            'formats': dict((fmt, {'seconds': round(seconds, 6), 'files': files, 'bytes_read': read})
+                            for fmt, (seconds, files, read) in formats.iteritems()),
+            'slowest': [{'path': path, 'format': fmt, 'seconds': round(seconds, 6), 'bytes_read': read}
+                        for seconds, path, fmt, read in sorted(slowest, reverse=True)],
+        }
+
+def write_report():
+    report = get_report()
+    if REPORT and REPORT.endswith('.json'):
+        with open(REPORT, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+        return
+    write = sys.stderr.write
+    write("Kindelabra profile\n")
+    for name in sorted(report['phases'], key=lambda name: -report['phases'][name]['seconds']):
+        values = report['phases'][name]
+        write("  %-16s %10.3fs %8d calls\n" % (name, values['seconds'], values['calls']))
+    for fmt in sorted(report['formats']):
+        values = report['formats'][fmt]
+        write("  %-16s %10.3fs %8d files %12d bytes read\n" % (fmt, values['seconds'], values['files'], values['bytes_read']))
+    for name in sorted(report['counters']):
+        write("  %-16s %10d\n" % (name, report['counters'][name]))
+    for entry in report['slowest']:
+        write("  %8.3fms %s\n" % (entry['seconds'] * 1000, entry['path']))
+
+if os.environ.get('KINDELABRA_PROFILE'):
+    enable(os.environ['KINDELABRA_PROFILE'])
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Headless batch operations on Kindle collections, without a GUI toolkit
+'''
+
+import argparse
+import fnmatch
+import locale
+import os
+import re
+import sys
+
+import instrument
+import kindle
+
+ENCODING = locale.getpreferredencoding() or 'utf-8'
+
+def out(*fields):
+    line = ' '.join(field if isinstance(field, unicode) else str(field).decode('utf-8', 'replace') for field in fields)
+    sys.stdout.write(line.encode(ENCODING, 'replace') + '\n')
+
+def fail(message):
+    sys.stderr.write("kindelabra: %s\n" % message)
+    sys.exit(1)
+
+class Session:
+    '''A Kindle with its collection database, saved once after all changes
+    '''
+    def __init__(self, args):
+        self.args = args
+        self.root = args.root
+        self.colfile = args.collections or os.path.join(self.root, 'system', 'collections.json')
+        self.kindle = kindle.Kindle(self.root, args.workers)
+        if not self.kindle.is_connected():
+            fail("%s is not a Kindle folder" % self.root)
+        self.db = kindle.CollectionDB(self.colfile)
+        self.scanned = False
+
+    def get_kindle(self):
+        if not self.scanned:
+            # Keep scan progress out of the command output
+            stdout = sys.stdout
+            sys.stdout = sys.stderr
+            try:
+                self.kindle.init_data()
+            finally:
+                sys.stdout = stdout
+            self.scanned = True
+        return self.kindle
+
+    def get_collection(self, name):
+        name = decode(name)
+        if not name in self.db:
+            fail("No such collection: %s" % name.encode(ENCODING, 'replace'))
+        return name
+
+    # Returns the Ebooks matched by the --glob, --folder and --asin options
+    def select_books(self):
+        if not (self.args.glob or self.args.folder or self.args.asin):
+            fail("Select books with --glob, --folder or --asin")
+        files = self.get_kindle().files
+        books = dict()
+        root = kindle.KINDLEROOT + '/'
+        if self.args.glob:
+            patterns = [compile_glob(pattern) for pattern in self.args.glob]
+            for book in files.itervalues():
+                segments = book.path[len(root):].split('/')
+                if any(match_glob(pattern, segments) for pattern in patterns):
+                    books[book.hash] = book
+        for folder in self.args.folder or ():
+            prefix = root + decode(folder).strip('/') + '/'
+            for book in files.itervalues():
+                if book.path.startswith(prefix):
+                    books[book.hash] = book
+        for asin in self.args.asin or ():
+            book = self.kindle.searchAsin(asin)
+            if book is None:
+                fail("ASIN %s not found on the device" % asin)
+            books[book.hash] = book
+        return sorted(books.values(), key=lambda book: book.path)
+
+    def save(self):
+        self.db.save(self.colfile)
+
+def decode(value):
+    if isinstance(value, str):
+        try:
+            return value.decode(ENCODING)
+        except UnicodeDecodeError:
+            return value.decode('utf-8')
+    return value
+
+# Returns a regex per folder of a glob pattern, so that * stays within a folder
+def compile_glob(pattern):
+    return [re.compile(fnmatch.translate(segment)) for segment in decode(pattern).strip('/').split('/')]
+
+def match_glob(pattern, segments):
+    return len(pattern) == len(segments) and all(regex.match(segment) for regex, segment in zip(pattern, segments))
+
+def list_collections(session):
+    if session.args.collection:
+        colname = session.get_collection(session.args.collection)
+        files = session.get_kindle().files
+        for item in session.db[colname]['items']:
+            key = kindle.get_item_key(item)
+            book = files.get(key) or session.kindle.searchAsin(key)
+            if book:
+                out(item, book.path, book.title or '')
+            else:
+                out(item, '(not on device)')
+    else:
+        for colname in sorted(session.db):
+            out(colname, len(session.db[colname]['items']))
+
+def create_collection(session):
+    for name in session.args.names:
+        name = decode(name)
+        if name in session.db:
+            fail("%s collection already exists" % name.encode(ENCODING, 'replace'))
+        session.db.add_collection(name, session.args.locale)
+
+def rename_collection(session):
+    colname = session.get_collection(session.args.collection)
+    newname = decode(session.args.newname)
+    if newname in session.db:
+        fail("%s collection already exists" % newname.encode(ENCODING, 'replace'))
+    session.db.rename_collection(colname, newname)
+
+def delete_collection(session):
+    for name in session.args.names:
+        del session.db[session.get_collection(name)]
+
+def add_books(session):
+    colnames = [session.get_collection(name) for name in session.args.collection]
+    added = session.db.add_many(colnames, session.select_books())
+    out("Added %d items" % len(added))
+
+def remove_books(session):
+    colnames = [session.get_collection(name) for name in session.args.collection]
+    removed = session.db.remove_many(colnames, session.select_books())
+    out("Removed %d items" % len(removed))
+
+def list_book_collections(session):
+    for book in session.select_books():
+        out(book.path, ', '.join(session.db.get_book_collections(book)) or '(in no collection)')
+
+def list_orphans(session):
+    orphans = session.db.get_orphans(session.get_kindle())
+    for colname in sorted(orphans):
+        for item in orphans[colname]:
+            out(colname, item)
+
+def purge_orphans(session):
+    out("Removed %d items" % session.db.purge_orphans(session.get_kindle()))
+
+def find_duplicates(session):
+    duplicates = session.get_kindle().find_duplicates()
+    for number, books in enumerate(duplicates, 1):
+        for book in books:
+            out(number, book.path)
+    if session.args.merge:
+        out("Removed %d items" % session.db.merge_duplicates(duplicates))
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Manage Kindle collections without the GUI")
+    parser.add_argument('root', help="Kindle home folder, containing documents and system")
+    parser.add_argument('--collections', help="collection file to edit, defaults to system/collections.json")
+    parser.add_argument('--workers', type=int, default=1, help="processes parsing ebooks while scanning")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='REPORT',
+                        help="time the scan, printing a summary at exit or writing a .json REPORT")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('list', help="list collections, or the items of one collection")
+    command.add_argument('collection', nargs='?')
+    command.set_defaults(run=list_collections)
+
+    command = commands.add_parser('create', help="create collections")
+    command.add_argument('names', nargs='+')
+    command.add_argument('--locale', default='en-US')
+    command.set_defaults(run=create_collection)
+
+    command = commands.add_parser('rename', help="rename a collection")
+    command.add_argument('collection')
+    command.add_argument('newname')
+    command.set_defaults(run=rename_collection)
+
+    command = commands.add_parser('delete', help="delete collections")
+    command.add_argument('names', nargs='+')
+    command.set_defaults(run=delete_collection)
+
+    command = commands.add_parser('orphans', help="list collection items of books missing from the device")
+    command.set_defaults(run=list_orphans)
+
+    command = commands.add_parser('purge', help="remove collection items of books missing from the device")
+    command.set_defaults(run=purge_orphans)
+
+    command = commands.add_parser('duplicates', help="list identical copies of books, numbered by group")
+    command.add_argument('--merge', action='store_true',
+                         help="replace the collection items of later copies by the first copy")
+    command.set_defaults(run=find_duplicates)
+
+    command = commands.add_parser('collections', help="list the collections holding each selected book")
+    add_selection(command)
+    command.set_defaults(run=list_book_collections)
+
+    for name, run, description in [('add', add_books, "add books to collections"),
+                                   ('remove', remove_books, "remove books from collections")]:
+        command = commands.add_parser(name, help=description)
+        command.add_argument('collection', nargs='+')
+        add_selection(command)
+        command.set_defaults(run=run)
+    return parser
+
+# Adds the options read by Session.select_books
+def add_selection(command):
+    command.add_argument('--glob', action='append',
+                         help="Kindle path pattern below the Kindle home, like 'documents/*.mobi', * doesn't match across folders")
+    command.add_argument('--folder', action='append', help="every book below a folder, like documents/comics")
+    command.add_argument('--asin', action='append', help="book with this ASIN")
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.profile:
+        instrument.enable(args.profile)
+    session = Session(args)
+    args.run(session)
+    # Read-only commands must not create a collection file on a device without one
+    if session.db.is_dirty():
+        session.save()
+
+if __name__ == "__main__":
+    main()
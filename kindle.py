@@ -6,53 +6,313 @@
 #license:Creative Commons GNU GPL v2
 # (http://creativecommons.org/licenses/GPL/2.0/)
 
+import contextlib
 import hashlib
 import os
+import datetime
 import re
 import json
+import shutil
 import sys
+import time
+import threading
 
-import ebook
+import instrument
+import schedule
+
+# simplejson decodes faster where it is installed, the json module is used
+# otherwise. Collections are always encoded by the json module so that saved
+# files don't depend on which is installed.
+try:
+    import simplejson as jsonlib
+except ImportError:
+    jsonlib = json
 
 KINDLEROOT = '/mnt/us'
 FILTER = ['pdf', 'mobi', 'prc', 'txt', 'tpz', 'azw1', 'azw', 'manga', 'azw2', 'zip']
 FOLDERS = ['documents', 'pictures']
+# EXTH records read while scanning: ASIN, CDE type and title
+EXTH_FIELDS = (113, 501, 503)
+FOLDER_REGEX = re.compile(r'.*(%s)' % '|'.join(FOLDERS))
+# Bump whenever the layout of a cache entry or the parsing of a format changes
+CACHE_VERSION = 2
+CACHE_FILE = 'kindelabra-cache.json'
+# Collection file backups kept by CollectionDB.save
+MAX_BACKUPS = 5
+# Files handed to a scan worker at a time
+CHUNKSIZE = 16
+# Files per progress report during a scan
+BATCH = 100
+# Threads hashing file contents when looking for duplicates, and bytes read at a time
+HASH_WORKERS = 4
+HASH_CHUNK = 1 << 20
 
 class Collection(dict):
     '''Holds a single collection
     '''
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.dirty = False
+        # Kept out of the dict, it is part of the collection's key in the file
+        self.locale = None
+        # Maps the hash or ASIN of each item to the raw item strings
+        self.index = dict()
+        for item in self.get('items', list()):
+            self.index.setdefault(get_item_key(item), list()).append(item)
+
     def has_hash(self, filehash):
-        for item in self['items']:
-            if not item.find(filehash) == -1:
-                return True
-        return False
+        return get_item_key(filehash) in self.index
+
+    # Returns (index, item) for each item with one of keys, by ascending index
+    def find_keys(self, keys):
+        if keys.isdisjoint(self.index):
+            return list()
+        return [(index, item) for index, item in enumerate(self['items']) if get_item_key(item) in keys]
+
+    def insert_items(self, pairs):
+        '''Inserts (index, item) pairs sorted by index, each index being the
+        item's position once all are inserted
+        '''
+        items = self['items']
+        if pairs[0][0] == len(items):
+            # Appended, as by add_many
+            items.extend(item for index, item in pairs)
+        else:
+            merged = list()
+            start = 0
+            for index, item in pairs:
+                count = index - len(merged)
+                merged.extend(items[start:start+count])
+                start += count
+                merged.append(item)
+            merged.extend(items[start:])
+            self['items'] = merged
+        for index, item in pairs:
+            self.index.setdefault(get_item_key(item), list()).append(item)
+        self.dirty = True
+
+    def remove_at(self, pairs):
+        '''Removes (index, item) pairs sorted by index, as found by find_keys
+        '''
+        items = self['items']
+        start = len(items) - len(pairs)
+        if pairs[0][0] == start:
+            del items[start:]
+        else:
+            indexes = set(index for index, item in pairs)
+            self['items'] = [item for index, item in enumerate(items) if not index in indexes]
+        for index, item in pairs:
+            key = get_item_key(item)
+            self.index[key].remove(item)
+            if not self.index[key]:
+                del self.index[key]
+        self.dirty = True
 
 class CollectionDB(dict):
     '''Holds a collection database
     '''
     def __init__(self, colfile):
+        self.colfile = colfile
+        self.dirty = False
+        # Operations to undo and redo, each a list of the steps it applied
+        self.undos = list()
+        self.redos = list()
+        # Steps of the operation in progress
+        self.steps = None
         #Fixes IOError if no collections.json is on the kindle
         try:
             with open(colfile) as colfile:
-                tmpjson = json.load(colfile)
+                tmpjson = decode_collections(colfile.read())
         except IOError:
-	        tmpjson = json.loads('{}')
+	        tmpjson = dict()
         tmpdict = dict()
-        for key in iter(tmpjson.keys()):
+        for key, collection in tmpjson.iteritems():
             split = key.rpartition('@')
             colname = unicode(split[0])
-            tmpdict[colname] = Collection(tmpjson[key])
-            tmpdict[colname]['locale'] = split[2]
+            if not isinstance(collection, Collection):
+                collection = Collection(collection)
+            collection.locale = split[2]
+            tmpdict[colname] = collection
         dict.__init__(self, tmpdict)
+        # Maps the hash or ASIN of each item to the collections holding it
+        self.members = dict()
+        for colname, collection in self.iteritems():
+            self.add_members(colname, collection.index)
+
+    def __setitem__(self, collection, value):
+        self.dirty = True
+        previous = self.get(collection)
+        if previous is not None:
+            self.remove_members(collection, previous.index)
+        dict.__setitem__(self, collection, value)
+        self.add_members(collection, value.index)
+        self.record(('set', collection, previous, value))
+
+    def __delitem__(self, collection):
+        self.dirty = True
+        value = self[collection]
+        self.remove_members(collection, value.index)
+        dict.__delitem__(self, collection)
+        self.record(('delete', collection, value))
+
+    @contextlib.contextmanager
+    def operation(self):
+        '''Groups the changes made in its block into a single undo step
+        '''
+        if self.steps is not None:
+            yield
+            return
+        self.steps = list()
+        try:
+            yield
+        finally:
+            steps, self.steps = self.steps, None
+            if steps:
+                self.undos.append(steps)
+                del self.redos[:]
+
+    def record(self, step):
+        if self.steps is None:
+            self.undos.append([step])
+            del self.redos[:]
+        else:
+            self.steps.append(step)
+
+    def undo(self):
+        '''Reverts the last operation. Returns the steps applied to do it,
+        None if there is nothing to undo
+        '''
+        if not self.undos:
+            return None
+        steps = self.replay(self.undos.pop())
+        self.redos.append(steps)
+        return steps
+
+    def redo(self):
+        '''Applies the last undone operation again. Returns the steps
+        applied, None if there is nothing to redo
+        '''
+        if not self.redos:
+            return None
+        steps = self.replay(self.redos.pop())
+        self.undos.append(steps)
+        return steps
+
+    # Applies the inverse of steps, last first, and returns the steps applied
+    def replay(self, steps):
+        self.steps = list()
+        try:
+            for step in reversed(steps):
+                self.apply(invert_step(step))
+            return self.steps
+        finally:
+            self.steps = None
+
+    def apply(self, step):
+        action, collection = step[:2]
+        if action == 'insert':
+            self.insert_items(collection, step[2])
+        elif action == 'remove':
+            self.remove_items(collection, step[2])
+        elif action == 'set':
+            self[collection] = step[3]
+        elif action == 'delete':
+            del self[collection]
+
+    # Steps changing items, every other change goes through __setitem__ and __delitem__
+    def insert_items(self, collection, pairs):
+        if pairs:
+            self[collection].insert_items(pairs)
+            self.add_members(collection, [get_item_key(item) for index, item in pairs])
+            self.record(('insert', collection, pairs))
+
+    def remove_items(self, collection, pairs):
+        if pairs:
+            self[collection].remove_at(pairs)
+            keys = set(get_item_key(item) for index, item in pairs)
+            self.remove_members(collection, [key for key in keys if not key in self[collection].index])
+            self.record(('remove', collection, pairs))
+
+    def append_items(self, collection, items):
+        start = len(self[collection]['items'])
+        self.insert_items(collection, list(enumerate(items, start)))
+
+    def add_members(self, collection, keys):
+        for key in keys:
+            self.members.setdefault(key, set()).add(collection)
 
-    # Converts the collection back to Kindle JSON format
+    def remove_members(self, collection, keys):
+        for key in keys:
+            self.members[key].discard(collection)
+            if not self.members[key]:
+                del self.members[key]
+
+    # Returns the names of the collections holding an Ebook
+    def get_book_collections(self, book):
+        collections = set(self.members.get(book.hash, ()))
+        if book.asin:
+            collections.update(self.members.get(book.asin, ()))
+        return sorted(collections)
+
+    def get_orphans(self, kindle):
+        '''Returns {collection: [item, ...]} for the items whose hash or ASIN
+        matches no file of a scanned Kindle
+        '''
+        orphans = dict()
+        for key in self.get_orphan_keys(kindle):
+            for collection in self.members[key]:
+                orphans.setdefault(collection, list()).extend(self[collection].index[key])
+        return orphans
+
+    def get_orphan_keys(self, kindle):
+        return set(key for key in self.members if not key in kindle.files and not key in kindle.asins)
+
+    def merge_duplicates(self, duplicates):
+        '''Replaces the hash items of the redundant copies in each group of
+        Kindle.find_duplicates by the first copy, returns the number of items
+        removed. ASIN items already stand for every copy.
+        '''
+        removed = 0
+        with self.operation():
+            for books in duplicates:
+                for book in books[1:]:
+                    for collection in list(self.members.get(book.hash, ())):
+                        pairs = self[collection].find_keys(set([book.hash]))
+                        self.remove_items(collection, pairs)
+                        removed += len(pairs)
+                        self.add_many([collection], books[:1])
+        return removed
+
+    def purge_orphans(self, kindle):
+        '''Removes the items of files missing from a scanned Kindle from every
+        collection, returns the number of items removed
+        '''
+        keys = self.get_orphan_keys(kindle)
+        collections = set()
+        for key in keys:
+            collections.update(self.members[key])
+        removed = 0
+        with self.operation():
+            for collection in collections:
+                pairs = self[collection].find_keys(keys)
+                self.remove_items(collection, pairs)
+                removed += len(pairs)
+        return removed
+
+    # Returns True if the collections changed since they were loaded or saved
+    def is_dirty(self):
+        if self.dirty:
+            return True
+        for collection in self.itervalues():
+            if collection.dirty:
+                return True
+        return False
+
+    # Converts the collection back to Kindle JSON format, sharing the Collections
     def toKindleDb(self):
         tmpjson = dict()
         for key in self:
-            tmpkey = '@'.join([key, self[key]['locale']])
-            tmpvalue = self[key].copy()
-            del tmpvalue['locale']
-            tmpjson[tmpkey] = tmpvalue
+            tmpjson['@'.join([key, self[key].locale])] = self[key]
         return tmpjson
 
     def in_collection(self, collection, filehash):
@@ -63,103 +323,529 @@ class CollectionDB(dict):
 
     def add_filehash(self, collection, filehash):
         filehash = '*'+filehash
-        self[collection]['items'].append(filehash)
+        self.append_items(collection, [filehash])
 
     def add_asin(self, collection, asin, booktype):
         asin = "#%s^%s" % (asin, booktype)
-        self[collection]['items'].append(asin)
+        self.append_items(collection, [asin])
 
-class Ebook():
-    def __init__(self, path):
-        self.path = get_kindle_path(path)
-        self.hash = get_hash(self.path)
+    # Adds an Ebook by ASIN, or by hash if it has none, unless already present
+    def add_book(self, collection, book):
+        if book.asin:
+            if not self.in_collection(collection, book.asin):
+                self.add_asin(collection, book.asin, book.type)
+                return True
+        elif not self.in_collection(collection, book.hash):
+            self.add_filehash(collection, book.hash)
+            return True
+        return False
+
+    def add_many(self, collections, books):
+        '''Adds each Ebook to each collection as add_book does, skipping books
+        already present. Returns the (collection, Ebook) pairs added.
+        '''
+        added = list()
+        with self.operation():
+            for collection in collections:
+                keys = set(self[collection].index)
+                items = list()
+                for book in books:
+                    key = book.asin or book.hash
+                    if not key in keys:
+                        keys.add(key)
+                        items.append(get_book_item(book))
+                        added.append((collection, book))
+                self.append_items(collection, items)
+        return added
+
+    def remove_many(self, collections, books):
+        '''Removes every item referring to each Ebook, by hash or ASIN, from
+        each collection. Returns the (collection, Ebook) pairs removed.
+        '''
+        keys = set()
+        for book in books:
+            keys.add(book.hash)
+            if book.asin:
+                keys.add(book.asin)
+        removed = list()
+        with self.operation():
+            for collection in collections:
+                pairs = self[collection].find_keys(keys)
+                self.remove_items(collection, pairs)
+                found = set(get_item_key(item) for index, item in pairs)
+                removed.extend((collection, book) for book in books
+                               if book.hash in found or book.asin in found)
+        return removed
+
+    def add_collection(self, collection, locale='en-US'):
+        self[collection] = Collection({'items': [], 'lastAccess': 0})
+        self[collection].locale = locale
+
+    def rename_collection(self, collection, newname):
+        with self.operation():
+            self[newname] = self[collection]
+            del self[collection]
+
+    def save(self, colfile):
+        '''Writes the collections to colfile unless unchanged since they were
+        read from it. The file is replaced atomically and the previous one
+        kept as a backup, returns False if there was nothing to save.
+        '''
+        if not self.is_dirty() and colfile == self.colfile and os.path.exists(colfile):
+            return False
+        folder = os.path.dirname(colfile)
+        tmpfile = colfile + '.tmp'
+        with open(tmpfile, 'wb') as jsonfile:
+            jsonfile.write(encode_collections(self.toKindleDb()))
+            jsonfile.flush()
+            os.fsync(jsonfile.fileno())
+        backup = None
+        if os.path.exists(colfile):
+            # The live file stays in place until the new one replaces it
+            backup = self.get_backup(folder)
+            shutil.copy2(colfile, backup)
+            if os.name == 'nt':
+                os.remove(colfile)
+        try:
+            os.rename(tmpfile, colfile)
+        except OSError:
+            if backup and not os.path.exists(colfile):
+                shutil.copy2(backup, colfile)
+            raise
+        self.colfile = colfile
+        self.dirty = False
+        for collection in self.itervalues():
+            collection.dirty = False
+        self.rotate_backups(folder)
+        return True
+
+    # Returns an unused backup path, names sort by the time they were made
+    def get_backup(self, folder):
+        now = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
+        number = 0
+        while True:
+            backup = os.path.join(folder, '%s%03d-collections.json.backup' % (now, number))
+            if not os.path.exists(backup):
+                return backup
+            number += 1
+
+    # Removes all but the newest MAX_BACKUPS collection file backups
+    def rotate_backups(self, folder):
+        backups = sorted(filename for filename in os.listdir(folder) if filename.endswith('-collections.json.backup'))
+        for filename in backups[:-MAX_BACKUPS]:
+            try:
+                os.remove(os.path.join(folder, filename))
+            except OSError:
+                pass
+
+class MetadataCache(dict):
+    '''Parsed ebook metadata kept between scans, keyed by Kindle path.
+    An entry is only valid while the file keeps the same size and mtime.
+    '''
+    def __init__(self, cachefile):
+        self.cachefile = cachefile
+        entries = dict()
+        try:
+            with open(cachefile, 'rb') as cache:
+                tmpjson = json.load(cache)
+            if tmpjson.get('version') == CACHE_VERSION:
+                entries = tmpjson['entries']
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+        dict.__init__(self, entries)
+        self.seen = dict()
+
+    def lookup(self, path, stat):
+        '''Returns the (title, asin, type, hash) entry for path if still valid
+        '''
+        entry = self.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            self.seen[path] = entry
+            return [encode(value) for value in entry[2:]]
+        return None
+
+    def keep(self, path):
+        if path in self:
+            self.seen[path] = self[path]
+
+    def store(self, book, stat):
+        try:
+            fields = [decode(value) for value in (book.title, book.asin, book.type, book.hash)]
+        except UnicodeDecodeError:
+            # Not representable in JSON, the file will simply be parsed again
+            return
+        self.seen[book.path] = [stat.st_size, stat.st_mtime] + fields
+
+    def save(self):
+        '''Writes the entries used in this scan, dropping files that are gone
+        '''
+        if self.seen == self:
+            return
+        tmpfile = self.cachefile + '.tmp'
+        try:
+            with open(tmpfile, 'wb') as cache:
+                cache.write(json.dumps({'version': CACHE_VERSION, 'entries': self.seen}, separators=(',', ':')))
+            if os.name == 'nt' and os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+            os.rename(tmpfile, self.cachefile)
+        except (IOError, OSError), e:
+            print "\nCould not write metadata cache:", e
+            return
+        self.clear()
+        self.update(self.seen)
+
+class Ebook(object):
+    '''The fields of an ebook file used to manage collections. The parser
+    object is dropped once they are read, see Kindle.read_metadata.
+    '''
+    __slots__ = ('path', 'hash', 'title', 'asin', 'type')
+
+    def __init__(self, path, cached=None, kindlepath=None):
+        if instrument.ENABLED:
+            started = time.time()
+        self.path = kindlepath or get_kindle_path(path)
         self.title = None
-        self.meta = None
         self.asin = None
         self.type = None
+        if cached:
+            self.title, self.asin, self.type, self.hash = cached
+            return
+        self.hash = get_hash(self.path)
         ext = os.path.splitext(path)[1][1:].lower()
+        if instrument.ENABLED:
+            instrument.add_phase('path_hash', time.time() - started)
+            started = instrument.file_started()
+            self.read_metadata(path, ext)
+            instrument.file_done(path, ext, started)
+        else:
+            self.read_metadata(path, ext)
+
+    # Slots without a __dict__ need explicit state to be sent from scan workers
+    def __getstate__(self):
+        return (self.path, self.hash, self.title, self.asin, self.type)
+
+    def __setstate__(self, state):
+        self.path, self.hash, self.title, self.asin, self.type = state
+
+    def read_metadata(self, path, ext):
+        meta = get_metadata(path, ext, EXTH_FIELDS)
         if ext in ['mobi', 'azw']:
-            self.meta = ebook.Mobi(path)
-            if self.meta.title:
-                self.title = self.meta.title
-                if 113 in self.meta.exth:
-                    self.asin = self.meta.exth[113]
-                if 501 in self.meta.exth:
-                    self.type = self.meta.exth[501]
-                if 503 in self.meta.exth:
-                    self.title = self.meta.exth[503]
+            if meta.title:
+                self.title = meta.title
+                if 113 in meta.exth:
+                    self.asin = meta.exth[113]
+                if 501 in meta.exth:
+                    self.type = meta.exth[501]
+                if 503 in meta.exth:
+                    self.title = meta.exth[503]
             else:
                 print "\nMetadata read error:", path
         elif ext in ['tpz', 'azw1']:
-            self.meta = ebook.Topaz(path)
-            if self.meta.title:
-                self.title = self.meta.title
-                if self.meta.asin:
-                    self.asin = self.meta.asin
-                if self.meta.type:
-                    self.type = self.meta.type
+            if meta.title:
+                self.title = meta.title
+                if meta.asin:
+                    self.asin = meta.asin
+                if meta.type:
+                    self.type = meta.type
             else:
                 print "\nTopaz metadata read error:", path
         elif ext in ['azw2']:
-            self.meta = ebook.Kindlet(path)
-            if self.meta.title:
-                self.title = self.meta.title
-            if self.meta.asin:
-                self.asin = self.meta.asin
+            if meta.title:
+                self.title = meta.title
+            if meta.asin:
+                self.asin = meta.asin
                 self.type = 'AZW2'
             else:
                 # Couldn't get an ASIN, developper app? We'll use the hash instead, which is what the Kindle itself does, so no harm done.
                 print "\nKindlet Metadata read error, assuming developper app:", path
 
+class ChangeSet:
+    '''Ebooks added, removed and modified by a scan
+    '''
+    def __init__(self):
+        self.added = list()
+        self.removed = list()
+        self.modified = list()
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.modified)
+
 class Kindle:
     '''Access a Kindle filesystem
     '''
-    def __init__(self, root):
+    def __init__(self, root, workers=1):
         self.root = unicode(root)
+        # Number of processes parsing ebook headers, 1 scans serially
+        self.workers = workers
+        self.files = dict()
+        # ASIN to the Ebooks having it, the first one added stands for all
+        self.asins = dict()
+        # Kindle path to hash of every file
+        self.paths = dict()
+        self.filetree = dict()
+        # State of the last scan: directory (mtime, subdirs, files) listings
+        # and file (size, mtime, hash) by filesystem path
+        self.dirs = dict()
+        self.stats = dict()
+        self.cache = None
+        # Held while a scan updates files and filetree
+        self.lock = threading.RLock()
 
-    def init_data(self):
+    def init_data(self, progress=None):
+        '''Scans the whole device, discarding the previous scan
+        '''
         self.files = dict()
+        self.asins = dict()
+        self.paths = dict()
         self.filetree = dict()
+        self.dirs = dict()
+        self.stats = dict()
+        self.cache = None
+        return self.refresh(progress)
+
+    def refresh(self, progress=None):
+        '''Rescans the device, parsing only files added or modified since the
+        last scan, and returns the ChangeSet applied to files and filetree.
+        progress is called with the ChangeSet of each batch of files, the
+        number of files done and the number to do.
+        '''
+        changes = ChangeSet()
+        dirs = dict()
+        stats = dict()
+        pending = list()
         if self.is_connected():
-            for folder in FOLDERS:
-                self.load_folder(folder)
-
-            for path in self.files:
-                regex = re.compile(r'.*?/(%s)' % '|'.join(FOLDERS))
-                self.get_filenodes(self.filetree, re.sub(regex, r'\1', self.files[path].path).split('/'))
-
-    def load_folder(self, path):
-        sys.stdout.write("Loading " + path)
-        for root, dirs, files in os.walk(os.path.join(self.root, path)):
-            for filename in files:
-                if os.path.splitext(filename)[1][1:].lower() in FILTER:
-                    fullpath = os.path.abspath(os.path.join(root, filename))
-                    book = Ebook(fullpath)
-                    self.files[book.hash] = book
+            if self.cache is None:
+                self.cache = MetadataCache(os.path.join(self.root, 'system', CACHE_FILE))
+            self.cache.seen.clear()
+            with instrument.phase('walk'):
+                for folder in FOLDERS:
+                    self.load_folder(folder, dirs, stats, pending)
+            with instrument.phase('schedule'):
+                self.order_pending(pending)
+            with instrument.phase('parse'):
+                self.load_books(pending, stats, changes, progress)
+        batch = ChangeSet()
+        with self.lock, instrument.phase('remove'):
+            for fullpath in self.stats:
+                filehash = self.stats[fullpath][2]
+                if not fullpath in stats and filehash in self.files:
+                    book = self.files[filehash]
+                    self.remove_book(book)
+                    batch.removed.append(book)
+            self.dirs = dirs
+            self.stats = stats
+        changes.removed = batch.removed
+        if progress and batch.removed:
+            progress(batch, len(pending), len(pending))
+        if self.cache is not None:
+            with instrument.phase('cache_save'):
+                self.cache.save()
+        instrument.count('files', len(stats))
+        instrument.count('files_parsed', len(pending))
+        instrument.count('files_removed', len(changes.removed))
+        return changes
+
+    # Collects the files under path that have to be parsed or read from the cache
+    def load_folder(self, path, dirs, stats, pending):
+        sys.stdout.write("Loading %s\n" % path)
+        for fullpath, stat in self.walk_folder(os.path.join(self.root, path), dirs):
+            previous = self.stats.get(fullpath)
+            if previous and previous[:2] == (stat.st_size, stat.st_mtime):
+                stats[fullpath] = previous
+                self.cache.keep(self.files[previous[2]].path)
+            else:
+                kindlepath = get_kindle_path(fullpath)
+                pending.append((fullpath, kindlepath, stat, self.cache.lookup(kindlepath, stat)))
+
+    # Puts the cached files first, as they need no reads, then the others in
+    # the order their data sits on disk
+    def order_pending(self, pending):
+        if schedule.ENABLED:
+            pending.sort(key=lambda (fullpath, kindlepath, stat, cached):
+                         (0, ) if cached is not None else (1, schedule.get_location(fullpath, stat)))
+
+    def load_books(self, pending, stats, changes, progress=None):
+        paths = [fullpath for fullpath, kindlepath, stat, cached in pending if cached is None]
+        pool = None
+        window = schedule.WINDOW
+        if self.workers > 1 and len(paths) > 1:
+            import multiprocessing
+            # Forked workers start without the phases recorded so far here,
+            # or they would send them back with their first results
+            pool = multiprocessing.Pool(self.workers, initializer=instrument.take)
+            # Workers run ahead of the results by up to a chunk each
+            window += self.workers * CHUNKSIZE
+        readahead = schedule.ReadAhead([(fullpath, stat.st_size) for fullpath, kindlepath, stat, cached in pending
+                                        if cached is None], window)
+        parsed = 0
+        try:
+            if pool:
+                books = (merge_profile(*result) for result in pool.imap(read_ebook, paths, CHUNKSIZE))
+            else:
+                books = (Ebook(fullpath, None, kindlepath) for fullpath, kindlepath, stat, cached in pending if cached is None)
+            batch = ChangeSet()
+            for done, (fullpath, kindlepath, stat, cached) in enumerate(pending, 1):
+                if cached is None:
+                    readahead.advance(parsed)
+                    book = books.next()
+                    parsed += 1
+                    self.cache.store(book, stat)
+                else:
+                    book = Ebook(fullpath, cached, kindlepath)
+                with self.lock:
+                    modified = self.update_book(fullpath, stat, book, stats)
+                for changeset in (changes, batch):
+                    if modified:
+                        changeset.modified.append(book)
+                    else:
+                        changeset.added.append(book)
+                if progress is None:
                     sys.stdout.write(".")
-        sys.stdout.write("\n")
+                elif len(batch) == BATCH or done == len(pending):
+                    progress(batch, done, len(pending))
+                    batch = ChangeSet()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if progress is None and pending:
+            sys.stdout.write("\n")
+
+    def walk_folder(self, top, dirs):
+        '''Yields (path, stat) for each ebook under top, reusing the listing of
+        directories whose mtime hasn't changed since the last scan
+        '''
+        folders = [top]
+        while folders:
+            root = folders.pop()
+            try:
+                mtime = os.stat(root).st_mtime
+            except OSError:
+                continue
+            listing = self.dirs.get(root)
+            # FAT only keeps mtimes to 2 seconds, a just modified directory may change again unnoticed
+            if listing is None or listing[0] != mtime or time.time() - mtime < 2:
+                subdirs = list()
+                files = list()
+                for name in os.listdir(root):
+                    fullpath = os.path.join(root, name)
+                    if os.path.isdir(fullpath):
+                        if not os.path.islink(fullpath):
+                            subdirs.append(name)
+                    elif os.path.splitext(name)[1][1:].lower() in FILTER:
+                        files.append(name)
+                listing = (mtime, subdirs, files)
+            dirs[root] = listing
+            for filename in listing[2]:
+                fullpath = os.path.abspath(os.path.join(root, filename))
+                try:
+                    stat = os.stat(fullpath)
+                except OSError:
+                    continue
+                yield fullpath, stat
+            folders.extend(os.path.join(root, subdir) for subdir in reversed(listing[1]))
+
+    # Records a parsed Ebook, returns True if it replaced a modified one
+    def update_book(self, fullpath, stat, book, stats):
+        stats[fullpath] = (stat.st_size, stat.st_mtime, book.hash)
+        modified = book.hash in self.files
+        if modified:
+            self.remove_book(self.files[book.hash])
+        self.add_book(book)
+        return modified
+
+    # Indexes a scanned Ebook by hash, ASIN and Kindle path, and adds it to filetree
+    def add_book(self, book):
+        self.files[book.hash] = book
+        self.paths[book.path] = book.hash
+        if book.asin:
+            self.asins.setdefault(book.asin, list()).append(book)
+        if instrument.ENABLED:
+            started = time.time()
+            self.get_filenodes(self.filetree, self.get_nodes(book))
+            instrument.add_phase('filetree', time.time() - started)
+        else:
+            self.get_filenodes(self.filetree, self.get_nodes(book))
+
+    def remove_book(self, book):
+        del self.files[book.hash]
+        del self.paths[book.path]
+        if book.asin:
+            books = self.asins[book.asin]
+            books.remove(book)
+            if not books:
+                del self.asins[book.asin]
+        self.del_filenodes(self.filetree, self.get_nodes(book))
+
+    def read_metadata(self, filehash):
+        '''Parses the file of a scanned Ebook again and returns the full
+        parser object, with every EXTH record of a Mobi
+        '''
+        book = self.files[filehash]
+        path = os.path.join(self.root, *book.path[len(KINDLEROOT)+1:].split('/'))
+        return get_metadata(path, os.path.splitext(path)[1][1:].lower())
+
+    def find_duplicates(self, workers=HASH_WORKERS):
+        '''Returns lists of Ebooks with identical contents, sorted by path.
+        Only files sharing their ASIN and size with another are read, and
+        hashed by a pool of worker threads.
+        '''
+        groups = dict()
+        for fullpath, (size, mtime, filehash) in self.stats.iteritems():
+            book = self.files[filehash]
+            groups.setdefault((book.asin, size), list()).append((fullpath, book))
+        candidates = [group for group in groups.itervalues() if len(group) > 1]
+        paths = [fullpath for group in candidates for fullpath, book in group]
+        digests = dict()
+        if paths:
+            import multiprocessing.pool
+            pool = multiprocessing.pool.ThreadPool(min(workers, len(paths)))
+            try:
+                digests = dict(zip(paths, pool.map(hash_file, paths)))
+            finally:
+                pool.close()
+                pool.join()
+        duplicates = list()
+        for group in candidates:
+            copies = dict()
+            for fullpath, book in group:
+                if digests[fullpath]:
+                    copies.setdefault(digests[fullpath], list()).append(book)
+            for books in copies.itervalues():
+                if len(books) > 1:
+                    duplicates.append(sorted(books, key=lambda book: book.path))
+        return sorted(duplicates, key=lambda books: books[0].path)
 
     def searchAsin(self, asin):
         '''Returns the Ebook with asin
         '''
-        for filehash in self.files:
-            if self.files[filehash].asin == asin:
-                asin_hash = self.files[filehash]
-                break
-            else:
-                asin_hash = None
-        return asin_hash
+        books = self.asins.get(asin)
+        if books:
+            return books[0]
+        return None
+
+    # Returns the folders and filename of an Ebook in filetree
+    def get_nodes(self, book):
+        return book.path[len(KINDLEROOT)+1:].split('/')
 
     # Adds files to the dictionary: tree
     def get_filenodes(self, tree, nodes):
+        for node in nodes[:-1]:
+            tree = tree.setdefault(node, dict())
+        if nodes:
+            tree.setdefault('files', list()).append(nodes[-1])
+
+    # Removes files from the dictionary: tree, pruning empty folders
+    def del_filenodes(self, tree, nodes):
         if len(nodes) > 1:
-            if not nodes[0] in tree:
-                tree[nodes[0]] = dict()
-            self.get_filenodes(tree[nodes[0]], nodes[1:])
-        elif len(nodes) == 1:
-            if not 'files' in tree:
-                tree['files'] = list()
-            tree['files'].append(nodes[0])
+            if nodes[0] in tree:
+                self.del_filenodes(tree[nodes[0]], nodes[1:])
+                if not tree[nodes[0]]:
+                    del tree[nodes[0]]
+        elif len(nodes) == 1 and nodes[0] in tree.get('files', ()):
+            tree['files'].remove(nodes[0])
+            if not tree['files']:
+                del tree['files']
 
     # Checks if the specified folder is a Kindle filestructure
     def is_connected(self):
@@ -167,12 +853,97 @@ class Kindle:
         sys = os.path.exists(os.path.join(self.root, 'system'))
         return docs and sys
 
+# Returns the collections of a collections.json by name@locale key
+def decode_collections(data):
+    return jsonlib.loads(data, object_hook=get_collection)
+
+def get_collection(obj):
+    if 'items' in obj:
+        return Collection(obj)
+    return obj
+
+# Returns the collections.json text for toKindleDb. json.dumps encodes in a
+# single C call, where json.dump writes many small chunks from Python code
+def encode_collections(tmpjson):
+    return json.dumps(tmpjson, separators=(',', ':'), ensure_ascii=True)
+
+# Returns the hash or ASIN identifying a *hash or #ASIN^type collection item
+def get_item_key(item):
+    if item.startswith('*'):
+        return item[1:]
+    elif item.startswith('#'):
+        return item[1:].partition('^')[0]
+    return item
+
+# Returns the parser object for a file, None if its format isn't parsed.
+# wanted limits the EXTH records read from a Mobi
+def get_metadata(path, ext, wanted=None):
+    # The parsers are only imported once a scan reads a file
+    import ebook
+    if ext in ['mobi', 'azw']:
+        return ebook.Mobi(path, wanted)
+    elif ext in ['tpz', 'azw1']:
+        return ebook.Topaz(path)
+    elif ext in ['azw2']:
+        return ebook.Kindlet(path)
+    return None
+
+# Returns the step undoing a CollectionDB journal step
+def invert_step(step):
+    action, collection = step[:2]
+    if action == 'insert':
+        return ('remove', collection, step[2])
+    elif action == 'remove':
+        return ('insert', collection, step[2])
+    elif action == 'set':
+        if step[2] is None:
+            return ('delete', collection, step[3])
+        return ('set', collection, step[3], step[2])
+    return ('set', collection, None, step[2])
+
+# Returns the collection item for an Ebook, by ASIN or by hash if it has none
+def get_book_item(book):
+    if book.asin:
+        return "#%s^%s" % (book.asin, book.type)
+    return '*' + book.hash
+
+# Parses a single file in a scan worker process
+def read_ebook(path):
+    return Ebook(path), instrument.take()
+
+# Adds the profile of a scan worker, returning its Ebook
+def merge_profile(book, profile):
+    instrument.merge(profile)
+    return book
+
 # Returns a full path on the kindle filesystem
 def get_kindle_path(path):
     path = os.path.normpath(path)
     folder = os.path.dirname(path)
     filename = os.path.basename(path)
-    return '/'.join([KINDLEROOT, re.sub(r'.*(documents|pictures)', r'\1', folder), filename]).replace('\\', '/')
+    return '/'.join([KINDLEROOT, FOLDER_REGEX.sub(r'\1', folder), filename]).replace('\\', '/')
+
+# Cache entries hold unicode, parsed metadata is utf-8 encoded str
+def decode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+# Returns the SHA-1 of a file's contents, None if it can't be read
+def hash_file(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), ''):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return digest.hexdigest()
 
 # Returns a SHA-1 hash
 def get_hash(path):
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#author:Richard Peng
+#project:Kindelabra
+#website:http://www.richardpeng.com/projects/kindelabra/
+#repository:https://github.com/richardpeng/Kindelabra
+#license:Creative Commons GNU GPL v2
+# (http://creativecommons.org/licenses/GPL/2.0/)
+
+'''Substring search over the titles, filenames and ASINs of scanned ebooks
+'''
+
+import posixpath
+
+# Length of the substrings indexed, query words shorter than this are
+# matched by scanning the candidates of the longer words, or every file
+GRAM = 3
+
+def get_text(book):
+    fields = [book.title, posixpath.basename(book.path), book.asin]
+    text = u' '.join(field if isinstance(field, unicode) else field.decode('utf-8', 'replace')
+                     for field in fields if field)
+    return text.lower()
+
+def get_grams(text):
+    return set(text[i:i+GRAM] for i in range(len(text) - GRAM + 1))
+
+class SearchIndex:
+    '''Trigram index of Ebooks by hash, updated from scan ChangeSets
+    '''
+    def __init__(self, books=()):
+        self.texts = dict()
+        self.grams = dict()
+        for book in books:
+            self.add(book)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, book):
+        self.remove(book)
+        text = get_text(book)
+        self.texts[book.hash] = text
+        for gram in get_grams(text):
+            self.grams.setdefault(gram, set()).add(book.hash)
+
+    def remove(self, book):
+        text = self.texts.pop(book.hash, None)
+        if text is None:
+            return
+        for gram in get_grams(text):
+            hashes = self.grams[gram]
+            hashes.discard(book.hash)
+            if not hashes:
+                del self.grams[gram]
+
+    # Applies a kindle.ChangeSet
+    def update(self, changes):
+        for book in changes.removed:
+            self.remove(book)
+        for book in changes.added + changes.modified:
+            self.add(book)
+
+    def search(self, query):
+        '''Returns the hashes of the Ebooks containing every word of query
+        '''
+        if isinstance(query, str):
+            query = query.decode('utf-8', 'replace')
+        words = query.lower().split()
+        if not words:
+            return set()
+        candidates = None
+        for word in words:
+            if len(word) < GRAM:
+                continue
+            for gram in sorted(get_grams(word), key=lambda gram: len(self.grams.get(gram, ()))):
+                hashes = self.grams.get(gram)
+                if not hashes:
+                    return set()
+                if candidates is None:
+                    candidates = set(hashes)
+                else:
+                    candidates.intersection_update(hashes)
+                if not candidates:
+                    return candidates
+        if candidates is None:
+            candidates = self.texts
+        # Trigrams can match out of order, so check the words themselves
+        return set(filehash for filehash in candidates
+                   if all(word in self.texts[filehash] for word in words))